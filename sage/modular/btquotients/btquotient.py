@@ -14,7 +14,7 @@ from sage.structure.element import Element
 from sage.matrix.constructor import Matrix
 from sage.matrix.matrix_space import MatrixSpace
 from sage.structure.sage_object import SageObject
-from sage.rings.all import ZZ,Zmod,QQ
+from sage.rings.all import ZZ,Zmod,QQ,GF
 from sage.misc.latex import latex
 from sage.plot import plot
 from sage.rings.padics.precision_error import PrecisionError
@@ -22,7 +22,7 @@ from itertools import islice
 import collections
 from sage.structure.unique_representation import UniqueRepresentation
 from sage.misc.cachefunc import cached_method
-from sage.rings.arith import gcd,xgcd,kronecker_symbol
+from sage.rings.arith import gcd,xgcd,kronecker_symbol,inverse_mod,CRT_list
 from sage.rings.padics.all import Qp,Zp
 from sage.algebras.quatalg.all import QuaternionAlgebra
 from sage.quadratic_forms.all import QuadraticForm
@@ -32,10 +32,26 @@ from sage.interfaces.all import magma
 from copy import copy
 from sage.plot.colors import rainbow
 from sage.rings.number_field.all import NumberField
+from sage.rings.polynomial.polynomial_ring_constructor import PolynomialRing
 from sage.modular.arithgroup.all import Gamma0
 from sage.misc.lazy_attribute import lazy_attribute
+from sage.misc.misc import cputime
+from sage.misc.all import prod
+from sage.functions.other import ceil
+from sage.structure.sage_object import dumps, loads
 from sage.modular.dirichlet import DirichletGroup
 from sage.modular.arithgroup.congroup_gammaH import GammaH_class
+import os, hashlib, math
+
+## Directory where the quotient graphs are stored between sessions, for
+## example os.path.join(DOT_SAGE,'btquotients'). The on-disk cache is
+## disabled when it is None.
+BTQUOTIENT_CACHE_DIR = None
+_QUOTIENT_CACHE_VERSION = 2
+
+## Maximum number of vectors of the norm form of the Eichler order
+## kept by BTQuotient._find_elements_in_order.
+NORM_FORM_CACHE_SIZE = 10**5
 
 class DoubleCosetReduction(SageObject):
     r"""
@@ -130,6 +146,30 @@ class DoubleCosetReduction(SageObject):
         self.power=g[1]+extrapow
         self._t_prec=-1
         self._igamma_prec=-1
+        self._splitting_epoch=Y._splitting_epoch
+
+    def _check_splitting(self):
+        r"""
+        Forgets the cached values of ``igamma`` and ``t`` if the
+        splitting of the quotient has changed since they were computed.
+
+        When the precision is increased by lifting the splitting, the
+        cached values remain valid approximations and are kept.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.btquotient import DoubleCosetReduction
+            sage: Y = BTQuotient(7,11)
+            sage: d = DoubleCosetReduction(Y,Matrix(ZZ,2,2,[123,45,88,1]))
+            sage: g = d.igamma(7)
+            sage: d._check_splitting()
+            sage: d._igamma_prec
+            7
+        """
+        if self._splitting_epoch != self._parent._splitting_epoch:
+            self._t_prec=-1
+            self._igamma_prec=-1
+            self._splitting_epoch=self._parent._splitting_epoch
 
 
     def sign(self):
@@ -203,6 +243,7 @@ class DoubleCosetReduction(SageObject):
 [                                                  O(7^7) 6 + 6*7 + 6*7^2 + 6*7^3 + 6*7^4 + 6*7^5 + 6*7^6 + O(7^7)]
         """
         Y = self._parent
+        self._check_splitting()
         if embedding is None:
             prec = Y._prec
         else:
@@ -238,6 +279,7 @@ class DoubleCosetReduction(SageObject):
             True
         """
         Y = self._parent
+        self._check_splitting()
         if prec is None:
             prec = max([5,Y._prec])
         if self._t_prec >= prec:
@@ -312,6 +354,280 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
         self._Mat_22=MatrixSpace(ZZ,2,2)
         self._mat_p001=self._Mat_22([self._p,0,0,1])
 
+    ## The methods whose name starts with ``_nf`` (together with
+    ## ``_edge_nf`` and ``_vertex_nf``) work with vertices and edges
+    ## given as the tuple of integer entries of their normalized
+    ## matrix representative. These tuples are canonical, so they can
+    ## be compared and hashed directly. Matrices are only built by the
+    ## public methods, when returning their results.
+
+    def _entries(self,M):
+        r"""
+        Returns the entries of the 2x2 matrix ``M``, lifted to `\ZZ`,
+        as a tuple.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._entries(Matrix(Zmod(9),2,2,[1,2,3,4]))
+            (1, 2, 3, 4)
+        """
+        if M.base_ring() is ZZ:
+            return tuple(M.list())
+        def lift(a):
+            try: return ZZ(a.lift())
+            except AttributeError: return ZZ(a)
+        return tuple([lift(x) for x in M.list()])
+
+    def _matrix(self,t):
+        r"""
+        Returns the immutable 2x2 integer matrix with entries ``t``.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._matrix((1,0,6,9))
+            [1 0]
+            [6 9]
+        """
+        M=self._Mat_22(list(t))
+        M.set_immutable()
+        return M
+
+    def _edge_nf(self,a,b,c,d):
+        r"""
+        Returns the entries of the normalized edge representative of
+        the matrix with integer entries ``a``, ``b``, ``c``, ``d``.
+
+        See :meth:`edge`.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._edge_nf(0,-1,3,0)
+            (0, 1, 3, 0)
+        """
+        p=self._p
+        v=min([x.valuation(p) for x in (a,b,c,d)])
+        if v != 0:
+            pv=p**v
+            a,b,c,d=a//pv,b//pv,c//pv,d//pv
+        m00=a.valuation(p)
+        m01=b.valuation(p)
+        det=(a*d-b*c).valuation(p)
+        if m00 <= m01:
+            pm=p**m00
+            bigpower=p**(1+det-m00)
+            g,s,_=xgcd(a//pm,bigpower)
+            return (pm,ZZ(0),(c*s)%bigpower,bigpower//p)
+        else:
+            pm=p**m01
+            bigpower=p**(det-m01)
+            g,s,_=xgcd(b//pm,bigpower)
+            return (ZZ(0),pm,bigpower,(d*s)%bigpower)
+
+    def _vertex_nf(self,a,b,c,d):
+        r"""
+        Returns the entries of the normalized vertex representative of
+        the matrix with integer entries ``a``, ``b``, ``c``, ``d``.
+
+        See :meth:`vertex`.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._vertex_nf(3,2,0,3)
+            (1, 0, 6, 9)
+            sage: T._vertex_nf(27,0,1,3)
+            (27, 0, 1, 3)
+        """
+        p=self._p
+        v=min([x.valuation(p) for x in (a,b,c,d)])
+        if v != 0:
+            pv=p**v
+            a,b,c,d=a//pv,b//pv,c//pv,d//pv
+        m00=a.valuation(p)
+        m01=b.valuation(p)
+        if m01<m00:
+            a,b,c,d=b,a,d,c
+            m00=m01
+        det=(a*d-b*c).valuation(p)
+        pm=p**m00
+        bigpower=p**(det-m00)
+        g,s,_=xgcd(a//pm,bigpower)
+        return (pm,ZZ(0),(c*s)%bigpower,bigpower)
+
+    def _nf_mul(self,x,y):
+        r"""
+        Returns the entries of the product of the 2x2 matrices with
+        entries ``x`` and ``y``.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._nf_mul((1,2,3,4),(0,1,1,0))
+            (2, 1, 4, 3)
+        """
+        a,b,c,d=x
+        e,f,g,h=y
+        return (a*e+b*g,a*f+b*h,c*e+d*g,c*f+d*h)
+
+    def _nf_origin(self,e):
+        r"""
+        Returns the origin of the normalized edge ``e``, as a tuple.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(7)
+            sage: T._nf_origin(T._edge_nf(1,5,8,9))
+            (1, 0, 1, 7)
+        """
+        a,b,c,d=e
+        p=self._p
+        return self._vertex_nf(p*b,a,p*d,c)
+
+    def _nf_opposite(self,e):
+        r"""
+        Returns the edge opposite to ``e``, as a tuple.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(7)
+            sage: T._nf_opposite((1,0,0,1))
+            (0, 1, 7, 0)
+        """
+        a,b,c,d=e
+        p=self._p
+        return self._edge_nf(p*b,a,p*d,c)
+
+    def _nf_leaving_edges(self,v):
+        r"""
+        Returns the edges leaving the vertex ``v``, as tuples.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._nf_leaving_edges(T._vertex_nf(1,0,0,1))
+            [(0, 1, 3, 0), (3, 0, 0, 1), (0, 1, 3, 1), (0, 1, 3, 2)]
+        """
+        try: A=self._nf_edges_leaving_origin
+        except AttributeError:
+            A=[self._entries(e) for e in self.edges_leaving_origin()]
+            self._nf_edges_leaving_origin=A
+        return [self._edge_nf(*self._nf_mul(v,x)) for x in A]
+
+    def _nf_children(self,e):
+        r"""
+        Returns the edges leaving the target of ``e`` other than the
+        one going back to its origin, as tuples. These correspond to
+        the `p` balls into which the ball of ``e`` is divided.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._nf_children((3,0,0,1))
+            [(9, 0, 0, 1), (0, 3, 3, 1), (0, 3, 3, 2)]
+        """
+        origin=self._nf_origin(self._edge_nf(*e))
+        return [e1 for e1 in self._nf_leaving_edges(self._vertex_nf(*e)) if self._vertex_nf(*e1)!=origin]
+
+    def _nf_subdivide(self,edgelist,level):
+        r"""
+        Returns the subdivision of the edges in ``edgelist``, given
+        as tuples. See :meth:`subdivide`.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: len(T._nf_subdivide([(3,0,0,1)],2))
+            9
+        """
+        for ii in range(level):
+            edgelist=[e1 for e in edgelist for e1 in self._nf_children(e)]
+        return edgelist
+
+    def _nf_subdivide_iter(self,e,level):
+        r"""
+        Iterates, depth-first, over the subdivision of the edge ``e``,
+        given as a tuple. See :meth:`subdivide_iter`.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: sorted(T._nf_subdivide_iter((3,0,0,1),2)) == sorted(T._nf_subdivide([(3,0,0,1)],2))
+            True
+        """
+        if level==0:
+            yield e
+            return
+        for e1 in self._nf_children(e):
+            for e2 in self._nf_subdivide_iter(e1,level-1):
+                yield e2
+
+    def _nf_find_path(self,v,boundary):
+        r"""
+        Computes the path from the normalized vertex ``v`` to the
+        dictionary ``boundary``, whose keys are tuples. See
+        :meth:`find_path`.
+
+        OUTPUT:
+
+          A list of tuples and the value in ``boundary`` of the
+          vertex where the path ends.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._nf_find_path(T._vertex_nf(9,0,0,1),{(1,0,0,1):'origin'})
+            ([(9, 0, 0, 1), (3, 0, 0, 1)], 'origin')
+        """
+        p=self._p
+        new_v=v
+        chain=[]
+        while new_v[2]!=0 or new_v[0].valuation(p)<new_v[3].valuation(p):
+            if boundary.has_key(new_v):
+                return chain,boundary[new_v]
+            chain.append(new_v)
+            a,b,c,d=new_v
+            new_v=self._vertex_nf(p*a,b,p*c,d)
+
+        while True:
+            if boundary.has_key(new_v):
+                return chain,boundary[new_v]
+            chain.append(new_v)
+            new_v=(new_v[0]//p,ZZ(0),ZZ(0),ZZ(1))
+        raise RuntimeError
+
+    def _nf_find_geodesic(self,v1,v2):
+        r"""
+        Returns the geodesic between the normalized vertices ``v1``
+        and ``v2``, as a list of tuples. See :meth:`find_geodesic`.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: T = BruhatTitsTree(3)
+            sage: T._nf_find_geodesic((3,0,0,1),(1,0,0,3))
+            [(3, 0, 0, 1), (1, 0, 0, 1), (1, 0, 0, 3)]
+        """
+        a,b,c,d=v2
+        vv=self._vertex_nf(*self._nf_mul((d,-b,-c,a),v1))
+        one=(ZZ(1),ZZ(0),ZZ(0),ZZ(1))
+        chain,v0=self._nf_find_path(vv,{one:one})
+        return [self._vertex_nf(*self._nf_mul(v2,x)) for x in chain+[v0]]
+
     def target(self,e,normalized = False):
         r"""
         Returns the target vertex of the edge represented by the
@@ -342,7 +658,7 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             return e
         else:
             #must normalize the target vertex representative
-            return self.vertex(e)
+            return self._matrix(self._vertex_nf(*self._entries(e)))
 
     def origin(self, e ,normalized = False):
         r"""
@@ -369,14 +685,11 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
 [1 7]
 
         """
+        x=self._entries(e)
         if not normalized:
             #then normalize
-            x=copy(self.edge(e))
-        else:
-            x=copy(M)
-        x.swap_columns(0,1)
-        x.rescale_col(0,self._p)
-        return self.vertex(x)
+            x=self._edge_nf(*x)
+        return self._matrix(self._nf_origin(x))
 
     def edge(self,M):
         r"""
@@ -399,45 +712,7 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             [0 1]
             [3 0]
         """
-        p=self._p
-        M_orig = M
-
-        def lift(a):
-            try: return ZZ(a.lift())
-            except AttributeError: return ZZ(a)
-
-        if M.base_ring() is not ZZ:
-            M = M.apply_map(lift,R = ZZ)
-
-        v=min([M[i,j].valuation(p) for i in range(2) for j in range(2)])
-
-        if v != 0:
-            M=p**(-v)*M
-
-        m00=M[0,0].valuation(p)
-        m01=M[0,1].valuation(p)
-
-        if m00 <= m01:
-            tmp=M.determinant().valuation(p)-m00
-            bigpower=p**(1+tmp)
-            r=M[0,0]
-            if r != 0:
-                r/=p**m00
-            g,s,_=xgcd(r,bigpower)
-            r=(M[1,0]*s)%bigpower
-            newM=self._Mat_22([p**m00,0,r,bigpower/p])
-        else:
-            tmp=M.determinant().valuation(p)-m01
-            bigpower=p**tmp
-            r = M[0,1]
-            if r!=0:
-                r/=p**m01
-            g,s,_ = xgcd(r,bigpower)
-            r=(ZZ(M[1,1])*s)%bigpower
-            newM=self._Mat_22([0,p**m01,bigpower,r])
-        newM.set_immutable()
-        # assert self.is_in_group(M_orig.inverse()*newM, as_edge = True)
-        return newM
+        return self._matrix(self._edge_nf(*self._entries(M)))
 
     # This function tests if a given matrix in Gamma0(p)
     #
@@ -489,39 +764,7 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             sage: t[1,0].valuation(p) > 0
             True
         """
-        p=self._p
-        M_orig = M
-        def lift(a):
-            try: return ZZ(a.lift())
-            except AttributeError: return ZZ(a)
-
-        if M.base_ring() is not ZZ:
-            M = M.apply_map(lift,R = ZZ)
-
-        v=min([M[i,j].valuation(p) for i in range(2) for j in range(2)])
-
-        if v != 0:
-            M=p**(-v)*M
-        m00=M[0,0].valuation(p)
-        m01=M[0,1].valuation(p)
-        if m01<m00:
-            M=copy(M)
-            M.swap_columns(0,1)
-            m00=m01
-        m10=M[1,0].valuation(p)
-        tmp=M.determinant().valuation(p)-m00
-        bigpower=p**tmp
-        r=M[0,0]
-        if r!=0:
-            r/=p**m00
-        # r = ZZ(r)%bigpower
-        g,s,_=xgcd(r,bigpower)
-        m10 = M[1,0]%bigpower
-        r = (m10*s)%bigpower
-        newM=self._Mat_22([p**m00,0,r,bigpower])
-        newM.set_immutable()
-        # assert self.is_in_group(M_orig.inverse()*newM, as_edge = False)
-        return newM
+        return self._matrix(self._vertex_nf(*self._entries(M)))
 
     def edges_leaving_origin(self):
         r""" 
@@ -590,13 +833,12 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             [0 1]
             [1 0]
         """
-        if normalized:
-            v22=v2
-        else:
-            v22=self.vertex(v2)
-        for e in self.leaving_edges(v1):
-            if self.target(e)==v22:
-                return e
+        v22=self._entries(v2)
+        if not normalized:
+            v22=self._vertex_nf(*v22)
+        for e in self._nf_leaving_edges(self._entries(v1)):
+            if self._vertex_nf(*e)==v22:
+                return self._matrix(e)
         raise ValueError, 'Vertices are not adjacent.'
 
     def leaving_edges(self,M):
@@ -622,7 +864,7 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             [7 0], [0 1], [7 1], [7 4], [7 5], [7 2], [7 3], [7 6]
             ]
         """
-        return [self.edge(M*A) for A in self.edges_leaving_origin()]
+        return [self._matrix(e) for e in self._nf_leaving_edges(self._entries(M))]
 
     def opposite(self,e):
         r""" 
@@ -649,10 +891,7 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             sage: T.opposite(T.opposite(e)) == e
             True
         """
-        x=copy(e)
-        x.swap_columns(0,1)
-        x.rescale_col(0,self._p)
-        return self.edge(x)
+        return self._matrix(self._nf_opposite(self._entries(e)))
 
     def entering_edges(self,v):
         r"""
@@ -677,7 +916,7 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             [0 1], [1 0], [1 1], [4 1], [5 1], [2 1], [3 1], [6 1]
             ]
         """
-        return [self.opposite(e) for e in self.leaving_edges(v)]
+        return [self._matrix(self._nf_opposite(e)) for e in self._nf_leaving_edges(self._entries(v))]
 
     def subdivide(self,edgelist,level):
         r""" 
@@ -708,19 +947,63 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             [ 0  1], [3 1], [3 2], [9 1], [9 4], [9 7], [9 2], [9 5], [9 8]
             ]
         """
-        all_edges=[]
         if(level<0):
             return []
         if(level==0):
             return [self._Mat_22(edge) for edge in edgelist]
-        else:
-            newEgood=[]
-            for edge in edgelist:
-                edge=self._Mat_22(edge)
-                origin=self.origin(edge)
-                newE=self.leaving_edges(self.target(edge))
-                newEgood.extend([e for e in newE if self.target(e)!=origin])
-            return self.subdivide(newEgood,level-1)
+        E=[self._entries(self._Mat_22(edge)) for edge in edgelist]
+        return [self._matrix(e) for e in self._nf_subdivide(E,level)]
+
+    def subdivide_iter(self,edgelist,level):
+        r"""
+        Iterates over the edges returned by :meth:`subdivide`, in
+        depth-first order, without building the list.
+
+        Only the path from the edges in ``edgelist`` to the current
+        edge is kept in memory, so that sums over fine coverings can be
+        computed in constant memory, or split in chunks (for example
+        with ``itertools.islice``).
+
+        INPUT:
+
+          - ``edgelist`` - a list of edges
+
+          - ``level`` - an integer
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: p = 3
+            sage: T = BruhatTitsTree(p)
+            sage: E = T.subdivide([Matrix(ZZ,2,2,[p,0,0,1])],2)
+            sage: L = list(T.subdivide_iter([Matrix(ZZ,2,2,[p,0,0,1])],2))
+            sage: len(L) == len(E) and all([e in E for e in L])
+            True
+        """
+        if(level<0):
+            return
+        for edge in edgelist:
+            edge=self._Mat_22(edge)
+            if(level==0):
+                yield edge
+                continue
+            for e in self._nf_subdivide_iter(self._entries(edge),level):
+                yield self._matrix(e)
+
+    def get_balls_iter(self,center=1,level=1):
+        r"""
+        Iterates over the balls returned by :meth:`get_balls`, without
+        building the list. See :meth:`subdivide_iter`.
+
+        EXAMPLES::
+
+            sage: from btquotients.btquotient import BruhatTitsTree
+            sage: p = 2
+            sage: T = BruhatTitsTree(p)
+            sage: len(list(T.get_balls_iter(Matrix(ZZ,2,2,[p,0,0,1]),1)))
+            6
+        """
+        return self.subdivide_iter(self.leaving_edges(center),level)
 
     def get_balls(self,center=1,level=1):
         r""" 
@@ -794,25 +1077,9 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             m=self._Mat_22(1)
             m.set_immutable()
             boundary = {m:m}
-        m=self._mat_p001
-        new_v=self.vertex(v)
-        chain=[]
-        while new_v[1,0]!=0 or new_v[0,0].valuation(self._p)<new_v[1,1].valuation(self._p):
-            if boundary.has_key(new_v):
-                return chain,boundary[new_v]
-            chain.append(new_v)
-            new_v=self.vertex(new_v*m)
-
-        if boundary.has_key(new_v):
-            return chain,boundary[new_v]
-
-        while True:
-            if boundary.has_key(new_v):
-                return chain,boundary[new_v]
-            chain.append(new_v)
-            new_v=self._Mat_22([new_v[0,0]/self._p,0,0,1])
-            new_v.set_immutable()
-        raise RuntimeError
+        boundary=dict([(self._entries(w),x) for w,x in boundary.iteritems()])
+        chain,v0=self._nf_find_path(self._vertex_nf(*self._entries(v)),boundary)
+        return [self._matrix(x) for x in chain],v0
 
     def find_containing_affinoid(self,z):
         r""" 
@@ -904,12 +1171,10 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
             [ 1  3], [ 0  1], [0 1], [0 1], [0 1], [0 3], [6 9]
             ]
         """
+        v1,v2=self._entries(v1),self._entries(v2)
         if not normalized:
-            v1,v2=self.vertex(v1),self.vertex(v2)
-        gamma=v2
-        vv=self.vertex(gamma.adjoint()*v1)
-        chain,v0=self.find_path(vv)
-        return [self.vertex(gamma*x) for x in chain+[v0]]
+            v1,v2=self._vertex_nf(*v1),self._vertex_nf(*v2)
+        return [self._matrix(x) for x in self._nf_find_geodesic(v1,v2)]
 
     def find_covering(self,z1,z2,level = 0):
         r"""
@@ -954,18 +1219,14 @@ class BruhatTitsTree(SageObject, UniqueRepresentation):
         """
         v1=self.find_containing_affinoid(z1)
         v2=self.find_containing_affinoid(z2)
-        vertex_set=[self._Mat_22(0)]+self.find_geodesic(v1,v2)+[self._Mat_22(0)]
-        total_dist = len(vertex_set) - 3
+        vertex_set=[None]+self._nf_find_geodesic(self._entries(v1),self._entries(v2))+[None]
         E=[]
         for ii in range(1,len(vertex_set)-1):
-            vv=vertex_set[ii]
-            m = vv.determinant().valuation(self._p)
-            newE=self.leaving_edges(vv)
-            for e in newE:
-                targ = self.target(e)
+            for e in self._nf_leaving_edges(vertex_set[ii]):
+                targ = self._vertex_nf(*e)
                 if targ!=vertex_set[ii-1] and targ != vertex_set[ii+1]:
-                    E.extend(self.subdivide([e],level))
-        return E
+                    E.extend(self._nf_subdivide([e],level))
+        return [self._matrix(e) for e in E]
 
 
 class Vertex(SageObject):
@@ -1094,6 +1355,58 @@ class Edge(SageObject):
         self.valuation=valuation
         self.parity=valuation%2
 
+def _quotient_frontier_job(X,v,pending):
+    r"""
+    Runs the equivalence tests that :meth:`BTQuotient._compute_quotient`
+    will need when expanding the vertex ``v``, against the edges
+    already leaving ``v`` and the vertices in ``pending``.
+
+    Only the fingerprints and the results of
+    :meth:`BTQuotient._are_equivalent` are returned, so that the
+    caller can store them in its caches and then update the graph
+    exactly as in the sequential computation.
+
+    EXAMPLES::
+
+        sage: from sage.modular.btquotients.btquotient import _quotient_frontier_job
+        sage: X = BTQuotient(5,13)
+        sage: v = X.get_vertex_list()[0]
+        sage: fps,eqs = _quotient_frontier_job(X,v,[])
+        sage: len(fps) > 0
+        True
+    """
+    p = X._p
+    fps = dict()
+    eqs = dict()
+    def fingerprint(m,as_edge,valuation):
+        fps[(m,as_edge)] = X._fingerprint(m,as_edge,valuation)
+        return fps[(m,as_edge)]
+    def equivalent(m1,m2,as_edge,twom):
+        eqs[(m1,m2,as_edge)] = X._are_equivalent(m1,m2,as_edge,twom)
+        return eqs[(m1,m2,as_edge)]
+    for e in X._BT.leaving_edges(v.rep):
+        edge_valuation = e.determinant().valuation(p)
+        fp = fingerprint(e,True,edge_valuation)
+        found = False
+        for e1 in v.leaving_edges:
+            if e1.parity != edge_valuation%2 or fingerprint(e1.rep,True,e1.valuation) != fp:
+                continue
+            if equivalent(e1.rep,e,True,edge_valuation+e1.valuation) is not None:
+                found = True
+                break
+        if found:
+            continue
+        target = X._BT.target(e)
+        target.set_immutable()
+        new_valuation = target.determinant().valuation(p)
+        fp = fingerprint(target,False,new_valuation)
+        for v1 in pending:
+            if v1.parity != new_valuation%2 or fingerprint(v1.rep,False,v1.valuation) != fp:
+                continue
+            if equivalent(target,v1.rep,False,new_valuation+v1.valuation) is not None:
+                break
+    return fps,eqs
+
 class BTQuotient(SageObject, UniqueRepresentation):
     @staticmethod
     def __classcall__(cls,p,Nminus,Nplus=1, character = None, use_magma = False, seed = None):
@@ -1104,8 +1417,7 @@ class BTQuotient(SageObject, UniqueRepresentation):
     by an arithmetic quaternionic group. The group in question is the
     group of norm 1 elements in an eichler Z[1/p]-order of some (tame)
     level inside of a definite quaternion algebra that is unramified
-    at the prime p. Note that this routine relies in Magma in the case
-    `p = 2` or when `Nplus > 1`.
+    at the prime p.
 
     INPUT:
 
@@ -1117,10 +1429,9 @@ class BTQuotient(SageObject, UniqueRepresentation):
        quotienting by.
      
      - ``Nplus`` - an integer corpime to pNminus (Default: 1). This is
-       the tame level. It need not be squarefree! If Nplus is not 1
-       then the user currently needs magma installed due to sage's
-       inability to compute well with nonmaximal Eichler orders in
-       rational (definite) quaternion algebras.
+       the tame level. It need not be squarefree! The Eichler order of
+       level Nplus is computed from local splittings of the maximal
+       order at the primes dividing Nplus.
     
      - ``character`` - a Dirichlet character (Default: 1). Its modulus
        must divide the product `p N^- N^+`.
@@ -1136,10 +1447,16 @@ class BTQuotient(SageObject, UniqueRepresentation):
         sage: G = X.get_graph(); G
         Multi-graph on 4 vertices
 
-    NOTES::
+    The tame level may be nontrivial, and `p` may be `2`::
 
-      A sage implementation of Eichler orders in rational quaternions
-      algebras would remove the dependency on magma.
+        sage: X = BTQuotient(5,7,2)
+        sage: X.genus() == X.genus_no_formula()
+        True
+        sage: X = BTQuotient(2,3,5)
+        sage: X._use_magma
+        False
+        sage: X.genus() == X.genus_no_formula()
+        True
 
     AUTHORS::
 
@@ -1152,7 +1469,7 @@ class BTQuotient(SageObject, UniqueRepresentation):
         1 elements in an eichler Z[1/p]-order of some (tame) level
         inside of a definite quaternion algebra that is unramified at
         the prime p. Note that this routine relies in Magma in the
-        case `p = 2` or when `Nplus > 1`.
+        case `p = 2`.
 
         EXAMPLES::
 
@@ -1187,7 +1504,7 @@ class BTQuotient(SageObject, UniqueRepresentation):
         self._p=p
         self._Nminus=Nminus
         self._Nplus=Nplus
-        if use_magma == True or self._Nplus != 1 or self._p == 2:
+        if use_magma == True:
             try:
                 self._magma=magma
                 magmap=self._magma(p)
@@ -1204,12 +1521,18 @@ class BTQuotient(SageObject, UniqueRepresentation):
 
         self._BT=BruhatTitsTree(p)
         self._prec=-1
+        self._splitting_epoch=0
         self._cached_vertices=dict()
         self._cached_edges=dict()
         self._cached_paths=dict()
         self._cached_decomps=dict()
         self._cached_equivalent=dict()
+        self._cached_fingerprints=dict()
+        self._fingerprint_skips=0
+        self._use_fingerprints=True
         self._CM_points=dict()
+        self._qfminim_calls=0
+        self._qfminim_time=0
 
         self._V=(QQ**4).ambient_module().change_ring(ZZ)
         self._Mat_44=MatrixSpace(ZZ,4,4)
@@ -1267,6 +1590,29 @@ class BTQuotient(SageObject, UniqueRepresentation):
             self._compute_quotient()
             return self._boundary
 
+    def _get_boundary_nf(self):
+        r"""
+        Returns the vertices of the quotient as a dict, keyed by the
+        tuple of entries of their representatives.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(37,3)
+            sage: sorted(X._get_boundary_nf().keys())
+            [(1, 0, 0, 1), (1, 0, 0, 37)]
+
+        The dict is rebuilt whenever the quotient is recomputed::
+
+            sage: X._compute_quotient(use_cache = False)
+            sage: X._get_boundary_nf() == dict([(X._BT._entries(w),v) for w,v in X.get_vertex_dict().iteritems()])
+            True
+        """
+        try: return self._boundary_nf
+        except AttributeError:
+            BT=self._BT
+            self._boundary_nf=dict([(BT._entries(w),v) for w,v in self.get_vertex_dict().iteritems()])
+            return self._boundary_nf
+
     def get_vertex_list(self):
         r"""
         Returns a list of the vertices of the quotient.
@@ -1820,6 +2166,13 @@ class BTQuotient(SageObject, UniqueRepresentation):
         Finds an embedding of the definite quaternion algebra
         into the algebra of 2x2 matrices with coefficients in `\QQ_p`.
 
+        For `p = 2` the maximal order has denominators `2` in terms of
+        `1, i, j, k`, so the splitting is the one given by
+        :meth:`_local_splitting_at`, which is conjugated so that the
+        maximal order is sent onto `M_2(\ZZ_2)`. It is computed again,
+        with some extra precision to absorb the conjugation, whenever
+        more precision is needed.
+
         INPUT:
 
         - prec - Integer. The precision of the splitting.
@@ -1835,6 +2188,22 @@ class BTQuotient(SageObject, UniqueRepresentation):
             sage: B.<i,j,k> = QuaternionAlgebra(3)
             sage: phi(i)**2 == QQ(i**2)*phi(B(1))
             True
+
+        ::
+
+            sage: X = BTQuotient(2,3)
+            sage: phi = X._local_splitting_map(10)
+            sage: all([x.valuation() >= 0 for q in X.get_maximal_order().basis() for x in phi(q).list()])
+            True
+
+        The Eichler order is sent onto `M_2(\ZZ_2)`::
+
+            sage: X = BTQuotient(2,3,5)
+            sage: A = X.get_embedding_matrix(10)
+            sage: all([x.valuation() >= 0 for x in A.list()])
+            True
+            sage: Matrix(GF(2),4,4,[x.lift() for x in A.list()]).determinant()
+            1
         """
         assert self._use_magma == False
         if(prec<=self._prec):
@@ -1852,24 +2221,85 @@ class BTQuotient(SageObject, UniqueRepresentation):
             raise ValueError, "p (=%s) must be an unramified prime"%self._p
         M = MatrixSpace(ZZp, 2)
 
-        if a.is_square():
-            alpha=a.sqrt()
-            self._II=M([alpha,0,2*alpha,-alpha])
+        if self._p == 2:
+            I,J,K=self._local_splitting_at(2,2*prec+20)
+            II,JJ,KK=[M([ZZp(x) for x in X.list()]) for X in (I,J,K)]
+            # Since p does not divide N^+, the Eichler order must be
+            # sent onto M_2(ZZ_2): its basis has integral images which
+            # span M_2(ZZ_2) modulo 2.
+            v=[w[0]+w[1]*II+w[2]*JJ+w[3]*KK for w in [q.coefficient_tuple() for q in self.get_eichler_order_basis()]]
+            if Matrix(GF(2),4,4,[x.list() for x in v]).determinant() == 0:
+                raise RuntimeError, "the 2-adic splitting does not send the Eichler order onto M_2(ZZ_2)"
+            self._II,self._JJ,self._KK=II,JJ,KK
+            return self._II, self._JJ, self._KK
+
+        # The splitting is determined by an integer z (None if a is a
+        # square) and a square root x of c = a*z^2+b (resp. of a). If c
+        # is a p-adic unit, x is stored in self._splitting_seed and
+        # Hensel-lifted when more precision is needed, so that the
+        # splitting at higher precision is congruent to the previous one.
+        try: seed=self._splitting_seed
+        except AttributeError: seed=None
+        if seed is not None:
+            z,c,x,n=seed
+            x=self._lift_square_root(c,x,n,prec)
+            self._splitting_seed=(z,c,x,max(n,prec))
+            x=ZZp(x)
+        else:
+            if a.is_square():
+                z=None
+                c=QQ(v[0])
+                x=a.sqrt()
+            else:
+                z=0
+                while not (a*z*z+b).is_square():
+                    z+=1
+                c=QQ(v[0]*z*z+v[1])
+                x=(a*z*z+b).sqrt()
+            if self._p != 2 and c.denominator() == 1 and ZZ(c) % self._p != 0:
+                self._splitting_seed=(z,ZZ(c),x.lift(),x.precision_absolute())
+
+        if z is None:
+            self._II=M([x,0,2*x,-x])
             self._JJ=M([b,-b,b-1,-b])
         else:
             self._II = M([0,a,1,0])
-            z=0
-            self._JJ=0
-            while(self._JJ==0):
-                c=a*z*z+b
-                if c.is_square():
-                    x=c.sqrt()
-                    self._JJ=M([x,-a*z,z,-x])
-                else:
-                    z+=1
+            self._JJ=M([x,-a*z,z,-x])
         self._KK = self._II*self._JJ
         return self._II, self._JJ, self._KK
 
+    def _lift_square_root(self,c,x,n,prec):
+        r"""
+        Hensel-lifts a square root of ``c`` from precision ``n`` to
+        precision ``prec``.
+
+        INPUT:
+
+        - ``c`` - an integer, not divisible by `p`.
+
+        - ``x`` - an integer such that `x^2 \equiv c \pmod{p^n}`.
+
+        - ``n``, ``prec`` - integers.
+
+        OUTPUT:
+
+        An integer congruent to ``x`` modulo `p^n`, whose square is
+        congruent to ``c`` modulo `p^{prec}`. Assumes that `p` is odd.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,13)
+            sage: x = X._lift_square_root(6,1,1,20)
+            sage: (x^2-6) % 5^20, x % 5
+            (0, 1)
+        """
+        p=self._p
+        while n < prec:
+            n=min(2*n,prec)
+            pn=p**n
+            x=(x-(x*x-c)*inverse_mod(2*x,pn))%pn
+        return x
+
     def _compute_embedding_matrix(self,prec, force_computation = False):
         r""" 
         Returns a matrix representing the embedding with the
@@ -1926,7 +2356,14 @@ class BTQuotient(SageObject, UniqueRepresentation):
         try: return self._extra_embedding_matrices
         except AttributeError: pass
         if self._use_magma == False:
-            self._extra_embedding_matrices = []
+            B = self.get_eichler_order_basis()
+            extra_embeddings = []
+            for l in self._extra_level:
+                if l == 1:
+                    continue
+                phi = self._local_splitting_map_at(l)
+                extra_embeddings.append(Matrix(GF(l),4,4,[phi(B[kk])[ii,jj].lift() for ii in range(2) for jj in range(2) for kk in range(4)]))
+            self._extra_embedding_matrices = extra_embeddings
         else:
             n_iters = 0
             Ord=self.get_eichler_order(magma = True)
@@ -1967,6 +2404,11 @@ class BTQuotient(SageObject, UniqueRepresentation):
         r"""
         Increase the working precision.
 
+        When possible, the local splitting and the inverse of the
+        embedding matrix are lifted from the current precision instead
+        of being computed again, so that the embedding at the new
+        precision is congruent to the previous one.
+
         INPUT:
 
            - ``amount`` Integer (Default: 1). The amount by which to
@@ -2033,8 +2475,9 @@ class BTQuotient(SageObject, UniqueRepresentation):
         if exact is True:
             try:
                 return self._Iota_exact
-            except:
-                raise RuntimeError, 'Exact splitting not available.'
+            except AttributeError:
+                self._compute_exact_splitting()
+                return self._Iota_exact
         else:
             if prec is None:
                 prec = self._prec
@@ -2052,13 +2495,54 @@ class BTQuotient(SageObject, UniqueRepresentation):
 
             if(prec>self._prec):
                 Iotamod=self._compute_embedding_matrix(prec)
-                self._Iotainv_lift=Iotamod.inverse().lift()
+                self._Iotainv_lift=self._lift_embedding_inverse(Iotamod,prec)
                 self._Iota=Matrix(self._R,4,4,[Iotamod[ii,jj] for ii in range(4) for jj in range(4)])
 
             self._prec=prec
             self._Iotainv=self._Mat_44([self._Iotainv_lift[ii,jj]%self._pN for ii in range(4) for jj in range(4)])
             return self._Iota
 
+    def _lift_embedding_inverse(self,Iotamod,prec):
+        r"""
+        Returns a lift to `\ZZ` of the inverse of the embedding matrix
+        ``Iotamod``, which has entries in `\ZZ/p^{prec}\ZZ`.
+
+        If ``Iotamod`` is congruent to the previous embedding matrix
+        (which is the case when the splitting has been lifted), the
+        previous inverse is lifted by Newton iteration. Otherwise the
+        inverse is computed from scratch, and the cached values of
+        the :class:`DoubleCosetReduction` objects are invalidated.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,7)
+            sage: A = X._compute_embedding_matrix(10)
+            sage: B = X._lift_embedding_inverse(A,10)
+            sage: A*B.change_ring(A.base_ring()) == 1
+            True
+        """
+        try:
+            X=self._Iotainv_lift.change_ring(Iotamod.base_ring())
+            old_prec=self._Iotainv_prec
+        except AttributeError:
+            X=None
+        if X is not None:
+            E=1-Iotamod*X
+            pn=self._p**min(old_prec,prec)
+            if any([x.lift() % pn != 0 for x in E.list()]):
+                X=None
+        if X is None:
+            if hasattr(self,'_Iotainv_lift'):
+                self._splitting_epoch+=1
+            self._Iotainv_prec=prec
+            return Iotamod.inverse().lift()
+        # If Iotamod*X = 1-E then Iotamod*X*(1+E) = 1-E^2
+        while E != 0:
+            X=X*(1+E)
+            E=E*E
+        self._Iotainv_prec=prec
+        return X.lift()
+
     def embed_quaternion(self, g, exact = False, prec=None):
         r"""
         Embeds the quaternion element ``g`` into a matrix algebra.
@@ -2141,7 +2625,7 @@ class BTQuotient(SageObject, UniqueRepresentation):
         """
         try: return self._edge_stabs
         except AttributeError:
-            self._edge_stabs=[self._stabilizer(e.rep,as_edge=True) for e in self.get_edge_list()]
+            self._edge_stabs=self._compute_stabilizers(as_edge=True)
             return self._edge_stabs
 
     def get_stabilizers(self):
@@ -2206,9 +2690,41 @@ TypeError: mutable matrices are unhashable
         """
         try: return self._vertex_stabs
         except AttributeError:
-            self._vertex_stabs=[self._stabilizer(e.rep,as_edge=False) for e in self.get_vertex_list()]
+            self._vertex_stabs=self._compute_stabilizers(as_edge=False)
             return self._vertex_stabs
 
+    def _compute_stabilizers(self,as_edge=True):
+        r"""
+        Returns the stabilizers of the edges (or vertices) of the
+        quotient graph, reading them from the on-disk cache (see
+        :meth:`_cache_file`) if possible, and storing them there
+        otherwise.
+
+        EXAMPLES::
+
+            sage: import sage.modular.btquotients.btquotient as btquotient
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = tmp_dir()
+            sage: X = BTQuotient(13,2)
+            sage: S = X._compute_stabilizers(as_edge=True)
+            sage: X._read_cache_data('edge_stabs') is not None
+            True
+            sage: BTQuotient(13,2)._compute_stabilizers(as_edge=True) == S
+            True
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = None
+        """
+        if as_edge:
+            name='edge_stabs'
+            L=self.get_edge_list()
+        else:
+            name='vertex_stabs'
+            L=self.get_vertex_list()
+        data=self._read_cache_data(name)
+        if data is not None and len(data['stabs']) == len(L):
+            return data['stabs']
+        stabs=[self._stabilizer(e.rep,as_edge=as_edge) for e in L]
+        self._write_cache_data(name,{'stabs':stabs})
+        return stabs
+
     def get_quaternion_algebra(self):
         r"""
         Returns the underlying quaternion algebra.
@@ -2283,17 +2799,15 @@ TypeError: mutable matrices are unhashable
 
     def get_splitting_field(self):
         r"""
-        Returns a quadratic field that splits the quaternion algebra attached to ``self``. Currently requires Magma.
+        Returns a quadratic field that splits the quaternion algebra attached to ``self``.
 
         EXAMPLES::
 
             sage: X = BTQuotient(5,11)
             sage: X.get_splitting_field()
-            Traceback (most recent call last):
-            ...
-            NotImplementedError: Sage does not know yet how to work with the kind of orders that you are trying to use. Try installing Magma first and set it up so that Sage can use it.
+            Number Field in a with defining polynomial x^2 + 1
 
-        If we do have Magma installed, then it works:
+        If we do have Magma installed, it can also be used:
 
         ::
 
@@ -2301,8 +2815,6 @@ TypeError: mutable matrices are unhashable
             sage: X.get_splitting_field() # optional - magma
             Number Field in a with defining polynomial X1^2 + 11
         """
-        if self._use_magma == False:
-            raise NotImplementedError,'Sage does not know yet how to work with the kind of orders that you are trying to use. Try installing Magma first and set it up so that Sage can use it.'
         try: return self._FF
         except AttributeError: pass
         self._compute_exact_splitting()
@@ -2398,16 +2910,62 @@ TypeError: mutable matrices are unhashable
             [ 1], [ 0]
             ]
         """
+        try: return self._O_units
+        except AttributeError: pass
         OM=self.get_eichler_order_quadmatrix()
-        v=pari('qfminim(%s,2,0, flag = 0)'%(OM._pari_()))
-        n_units=Integer(v[0].python()/2)
-        v=pari('qfminim(%s,2,%s, flag = 2)'%((OM._pari_()),n_units))
+        n_units=Integer(self._qfminim(OM,2,0,flag = 0)[0]/2)
+        mat=self._qfminim(OM,2,n_units,flag = 2)[2]
         O_units=[]
         for jj in range(n_units):
-            vec=Matrix(ZZ,4,1,[v[2][ii,jj].python() for ii in range(4)])
+            vec=mat.matrix_from_columns([jj])
             O_units.append(vec)
+        self._O_units=O_units
         return O_units
 
+    def _qfminim(self,A,B,m,flag = 0):
+        r"""
+        Calls PARI's ``qfminim`` on the integral quadratic form ``A``,
+        keeping track of the number of calls and the time spent in them
+        (in the attributes ``_qfminim_calls`` and ``_qfminim_time``).
+
+        The matrix is handed to PARI as a ``gen``, so no string has to be
+        printed and parsed back, and the vectors found are converted at
+        once into a matrix over `\ZZ`.
+
+        INPUT:
+
+        - ``A`` - an integral symmetric matrix
+        - ``B``, ``m``, ``flag`` - the arguments to ``qfminim``
+
+        OUTPUT:
+
+        A triple formed by the number of vectors found (as an Integer),
+        the largest norm found and a matrix over `\ZZ` whose columns are
+        the vectors stored.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,7)
+            sage: n = X._qfminim_calls
+            sage: v = X._qfminim(X.get_eichler_order_quadmatrix(),2,0)
+            sage: X._qfminim_calls == n+1
+            True
+            sage: v[2].ncols()
+            0
+            sage: v = X._qfminim(X.get_eichler_order_quadmatrix(),2,1)
+            sage: v[2].parent()
+            Full MatrixSpace of 4 by 1 dense matrices over Integer Ring
+        """
+        t=cputime()
+        v=A._pari_().qfminim(B,m,flag)
+        self._qfminim_time+=cputime(t)
+        self._qfminim_calls+=1
+        if v[2].ncols() == 0:
+            mat=Matrix(ZZ,A.nrows(),0)
+        else:
+            mat=Matrix(ZZ,v[2].sage())
+        return Integer(v[0]),v[1].sage(),mat
+
     def _is_new_element(self,x,old_list,unit_list):
         for tt in old_list:
             for u in unit_list:
@@ -2562,76 +3120,152 @@ TypeError: mutable matrices are unhashable
                 self._increase_precision(10)
         return T
 
+    def _hecke_coset_key(self,x,l,S_integral):
+        r"""
+        Returns a hashable key for the right ideal generated by the
+        quaternion ``x`` of reduced norm `l` times a power of `p`, so
+        that two such quaternions `x`, `y` have the same key if and
+        only if `x^{-1}y` belongs to `R[1/p]` (if ``S_integral`` is
+        True) or to `R` (otherwise), where `R` is the Eichler order.
+
+        The key is the Hermite normal form of the lattice `xR + lR`
+        after clearing the powers of `p` in the denominators in the
+        first case, and of the lattice `dxR` together with its
+        denominator `d` in the second.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,13)
+            sage: x = X._conv(X._find_elements_in_order(3)[0])
+            sage: X._hecke_coset_key(x,3,True) == X._hecke_coset_key(5*x,3,True)
+            True
+        """
+        BB = self._BB
+        M = Matrix(QQ,4,4,[(BB*Matrix(QQ,4,1,(x*b).coefficient_tuple())).list() for b in self._B])
+        d = M.denominator()
+        M = (d*M).change_ring(ZZ)
+        if S_integral:
+            M = M.stack(l*self._Mat_44(1))
+            return tuple(M.echelon_form().list()[:16])
+        return (d,tuple(M.echelon_form().list()))
+
     @cached_method
     def _get_hecke_data(self,l):
         r"""
+        Returns (computes if necessary) data to compute the Hecke
+        operator at a prime `l`.
+
+        The `l+1` cosets are obtained by enumerating the primitive
+        elements of the order of reduced norm `l p^{2k}` for
+        increasing `k` and keeping one element for each right ideal
+        that they generate (see :meth:`_hecke_coset_key`). The
+        elements found are stored on disk (see :meth:`_cache_file`),
+        so that only the double coset reductions need to be redone in
+        later sessions.
+
+        If `l` divides the level, or if there are expected to be more
+        than ``NORM_FORM_CACHE_SIZE`` elements of reduced norm at most
+        `l p^{2k}` (which happens already for `k = 1` when `p` is
+        moderately large), the remaining elements are found as
+        products of generators of the arithmetic group by a fixed
+        element of norm `l`. The number of elements of norm at most
+        `n` is estimated as `2\pi^2 n^2/\sqrt{\det(A)}`, where `A` is
+        the matrix of twice the norm form, so that no enumeration is
+        needed to decide.
 
-        """
-        # print 'Getting hecke data for prime ',l,'...'
-        def enumerate_words(v):
-            n=[]
-            while True:
-                add_new = True
-                for jj in range(len(n)):
-                    n[jj] += 1
-                    if n[jj] != len(v):
-                        add_new = False
-                        break
-                    else:
-                        n[jj] = 0
-                if add_new:
-                    n.append(0)
-                yield prod([v[x] for x in n])
+        OUTPUT:
+
+        A pair ``T``, ``alpha``, where ``alpha`` is an element of
+        reduced norm `l` (times a power of `p`) and ``T`` a list of
+        pairs ``[gamma,reductions]`` such that the ``gamma*alpha``
+        represent the cosets.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,13)
+            sage: T,alpha = X._get_hecke_data(3)
+            sage: len(T)
+            4
+
+        For larger `p` the norm `l p^2` is not enumerated::
 
+            sage: X = BTQuotient(53,11,2) # long time
+            sage: T,alpha = X._get_hecke_data(3) # long time
+            sage: len(T) # long time
+            4
+        """
         E=self.get_edge_list()
-        # self._increase_precision(20)
         if (self.level()*self.Nplus())%l == 0:
             Sset=[]
         else:
             Sset=[self._p]
         BB=self._BB
         p = self._p
-        T=[]
-        T0=[]
-        V=[]
-        nninc=-2
-        while len(V) == 0:
-            nninc+=2
-            V = filter(lambda g:prod([self._character(ZZ((v*Matrix(ZZ,4,1,g))[0,0]))/self._character((p**ZZ(nninc/2))) for v in self.get_extra_embedding_matrices()]) == 1, self._find_elements_in_order(l*p**nninc))
+        A = self.get_quaternion_algebra()
 
-        alpha1 = V[0]
-        alpha0 = self._conv(alpha1)
+        def character_condition(g,nn):
+            return prod([self._character(ZZ((v*Matrix(ZZ,4,1,g))[0,0]))/self._character((p**ZZ(nn/2))) for v in self.get_extra_embedding_matrices()]) == 1
+
+        data = self._read_cache_data('hecke%s'%l)
+        if data is not None:
+            alpha1 = data['alpha']
+            gammas = [Matrix(QQ,4,1,v) for v in data['gammas']]
+        else:
+            V=[]
+            nninc=-2
+            while len(V) == 0:
+                nninc+=2
+                V = filter(lambda g:character_condition(g,nninc), self._find_elements_in_order(l*p**nninc))
+
+            alpha1 = V[0]
+            alpha0inv = self._conv(alpha1)**(-1)
+            gammas = []
+            seen = set()
+            def add_coset(x,gamma):
+                key = self._hecke_coset_key(x,l,len(Sset)>0)
+                if key not in seen:
+                    seen.add(key)
+                    gammas.append(BB*Matrix(QQ,4,1,A(gamma).coefficient_tuple()))
+
+            if len(Sset) > 0:
+                ## Only enumerate the norms with few vectors below them
+                det = self.get_eichler_order_quadmatrix().determinant()
+                max_norm = math.sqrt(NORM_FORM_CACHE_SIZE*math.sqrt(float(det))/(2*math.pi**2))
+                nn = nninc
+                while len(gammas)<l+1 and l*p**nn <= max_norm:
+                    for g in self._find_elements_in_order(l*p**nn,primitive = True):
+                        if character_condition(g,nn):
+                            x = self._conv(g)
+                            add_coset(x,x*alpha0inv)
+                            if len(gammas) == l+1:
+                                break
+                    nn += 2
+            if len(gammas)<l+1:
+                alpha0 = self._conv(alpha1)
+                letters = self.get_generators() + filter(lambda g:character_condition(g,0), self._find_elements_in_order(1))
+                letters = [self._conv(y) for y in letters]
+                words = [A(1)]
+                while len(gammas)<l+1:
+                    v = words.pop(0)
+                    x = v*alpha0
+                    if len(Sset) == 0:
+                        ## Normalize the powers of p coming from the generators
+                        x = x/(x.reduced_norm()/(l*p**nninc)).sqrt()
+                    add_coset(x,v)
+                    words.extend([v*y for y in letters])
+            self._write_cache_data('hecke%s'%l,{'alpha':list(alpha1),'gammas':[v.list() for v in gammas]})
 
         alpha = Matrix(QQ,4,1,alpha1)
-        alphamat = self.embed_quaternion(alpha)
-        letters = self.get_generators() + filter(lambda g:prod([self._character(ZZ((v*Matrix(ZZ,4,1,g))[0,0]))/self._character((p**ZZ(nninc/2))) for v in self.get_extra_embedding_matrices()]) == 1, self._find_elements_in_order(1))
-        I=enumerate_words([self._conv(x) for x in letters])
-        n_iters = 0
-        while len(T)<l+1: # or n_iters < 200:
-            n_iters += 1
-            v = I.next()
-            v0 = v*alpha0
-            vinv = self.get_quaternion_algebra()(v0**(-1))
-            new = True
-            for tt in T0:
-                r = vinv*tt
-                r_in_order = BB*Matrix(QQ,4,1,r.coefficient_tuple())
-                if all([a.is_S_integral(Sset) for a in r_in_order.list()]):
-                    new = False
+        T=[]
+        for v1 in gammas:
+            while True:
+                try:
+                    x = self.embed_quaternion(v1)*self.embed_quaternion(alpha)
+                    nn = ceil(x.determinant().valuation())
+                    T.append([v1,[DoubleCosetReduction(self,x.adjoint()*e.rep,extrapow=nn) for e in E]])
                     break
-            if new:
-                v1 = BB*Matrix(QQ,4,1,v.coefficient_tuple())
-                success = False
-                while not success:
-                    try:
-                        x = self.embed_quaternion(v1)*alphamat
-                        nn = ceil(x.determinant().valuation())
-                        T.append([v1,[DoubleCosetReduction(self,x.adjoint()*e.rep,extrapow=nn) for e in E]])
-                        success = True
-                    except PrecisionError:
-                        self._increase_precision(10)
-                        alphamat = self.embed_quaternion(alpha)
-                T0.append(v0)
+                except PrecisionError:
+                    self._increase_precision(10)
         assert len(T) == l+1
         return T,alpha
 
@@ -2667,7 +3301,11 @@ TypeError: mutable matrices are unhashable
         if valuation is None:
             valuation=v0.determinant().valuation(self._p)
         parity=valuation%2
+        fp=self._fingerprint(v0,False,valuation)
         for v in filter(lambda v:v.parity==parity,V):
+            if self._fingerprint(v.rep,False,v.valuation) != fp:
+                self._fingerprint_skips+=1
+                continue
             g=self._are_equivalent(v0,v.rep,False,valuation+v.valuation)
             if g is not None:
                 self._cached_vertices[v0]=(g,v)
@@ -2709,13 +3347,90 @@ TypeError: mutable matrices are unhashable
                 E=self._edge_list
             else:
                 E=[e.opposite for e in self._edge_list]
+        fp=self._fingerprint(e0,True,valuation)
         for e in filter(lambda x:x.parity==parity,E):
+            if self._fingerprint(e.rep,True,e.valuation) != fp:
+                self._fingerprint_skips+=1
+                continue
             g = self._are_equivalent(e.rep,e0,True,valuation+e.valuation)
             if g is not None:
                 self._cached_edges[e0]=(g,e)
                 return g,e
         return 0,None
 
+    def _fingerprint(self,v,as_edge=False,valuation=None):
+        r"""
+        Returns an invariant of the orbit of a vertex (or edge) under
+        the arithmetic group, used to rule out candidates before
+        calling :meth:`_are_equivalent`.
+
+        If ``v`` has determinant of valuation `m`, the lattice attached
+        to the pair ``v``, ``v`` is `p^m` times the order of elements of
+        `R[1/p]` stabilizing ``v``, and the orders of equivalent vertices
+        (or edges) are conjugate. Hence the number of elements of this
+        lattice of reduced norm at most `p^{2m}`, in `(p^{2m},2p^{2m}]`
+        and in `(2p^{2m},3p^{2m}]` only depends on the orbit of ``v``.
+        Only the counts returned by ``qfminim`` are used, so no vectors
+        are stored.
+
+        INPUT:
+
+        - ``v`` - a 2x2 matrix representing a vertex or an edge
+        - ``as_edge`` - boolean (Default: False)
+        - ``valuation`` - integer (Default: None). The valuation of
+          the determinant of ``v``, if known.
+
+        OUTPUT:
+
+        A tuple of three integers, or None if the attribute
+        ``_use_fingerprints`` is False, in which case no candidate is
+        ruled out.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,13)
+            sage: V = X.get_vertex_list()
+            sage: X._fingerprint(V[0].rep) == X._fingerprint(V[0].rep)
+            True
+            sage: X._fingerprint(V[0].rep)[0] > 0
+            True
+
+        Candidates with a different fingerprint are skipped without
+        calling :meth:`_are_equivalent`::
+
+            sage: X = BTQuotient(5,7,12)
+            sage: G = X.get_graph(); G
+            Multi-graph on 24 vertices
+            sage: X._fingerprint_skips > 0
+            True
+
+        The quotient is the same without the pruning::
+
+            sage: X._use_fingerprints = False
+            sage: X._cached_vertices.clear(); X._cached_edges.clear(); X._cached_equivalent.clear()
+            sage: n = X._fingerprint_skips
+            sage: X._compute_quotient(use_cache = False)
+            sage: X._fingerprint_skips == n
+            True
+            sage: X.get_graph().is_isomorphic(G)
+            True
+            sage: X._use_fingerprints = True
+        """
+        if not self._use_fingerprints:
+            return None
+        try:
+            return self._cached_fingerprints[(v,as_edge)]
+        except KeyError: pass
+        p=self._p
+        if valuation is None:
+            valuation=v.determinant().valuation(p)
+        pm=p**(2*valuation)
+        E,A=self._find_lattice(v,v,as_edge,2*valuation)
+        counts=[self._qfminim(A,2*k*pm,0)[0] for k in range(1,4)]
+        fp=(counts[0],counts[1]-counts[0],counts[2]-counts[1])
+        self._cached_fingerprints[(v,as_edge)]=fp
+        return fp
+
     def fundom_rep(self,v1):
         r"""
         Finds an equivalent vertex in the fundamental domain.
@@ -2736,10 +3451,11 @@ TypeError: mutable matrices are unhashable
             return tmp
         except KeyError: pass
         # print 'v1=',v1
-        chain,v=self._BT.find_path(v1,self.get_vertex_dict())
+        BT=self._BT
+        chain,v=BT._nf_find_path(BT._vertex_nf(*BT._entries(v1)),self._get_boundary_nf())
         # print 'chain =', chain
         while(len(chain)>0):
-            v0=chain.pop()
+            v0=BT._matrix(chain.pop())
             g,v=self._find_equivalent_vertex(v0,V=[e.target for e in v.leaving_edges])
             assert not v is None
             self._cached_paths[v0]=v
@@ -2809,7 +3525,7 @@ TypeError: mutable matrices are unhashable
         n_units=len(self.get_units_of_order())
         ## Using PARI to get the shortest vector in the lattice (via LLL)
         ## We used to pass qfminim flag = 2
-        mat = pari('qfminim(%s,0,%s)'%(A._pari_(),2*n_units))[2].python().transpose()
+        mat = self._qfminim(A,0,2*n_units)[2].transpose()
         n_vecs=mat.nrows()
         stabs=[]
         for jj in range(n_vecs):
@@ -2830,10 +3546,10 @@ TypeError: mutable matrices are unhashable
     def _extra_level_check(self,vec, twom, E, A, flag = 0):
         """
         """
-        if self._use_magma == False or len(self._extra_level) == 0:
+        if len(self._extra_level) == 0 or (self._use_magma == False and self._extra_level == [1]):
             return E*vec, True
         m = ZZ(twom/2)
-        mat = pari('qfminim(%s,0,%s,flag = %s)'%(A._pari_(),1000,flag))[2].python().transpose()
+        mat = self._qfminim(A,0,1000,flag = flag)[2].transpose()
         n_vecs = mat.nrows()
         p = self._p
         for jj in range(n_vecs):
@@ -2893,7 +3609,7 @@ TypeError: mutable matrices are unhashable
                 return None
         E,A=self._find_lattice(v1,v2,as_edges,twom)
         ## Using PARI to get the shortest vector in the lattice (via LLL)
-        vec=pari('qfminim(%s,0,1,flag = 0)'%(A._pari_()))[2].python()
+        vec=self._qfminim(A,0,1,flag = 0)[2]
 
         vect=vec.transpose()
         nrd=Integer((vect*A*vec)[0,0]/2)
@@ -2908,7 +3624,38 @@ TypeError: mutable matrices are unhashable
         return None
 
     def _compute_exact_splitting(self):
+        r"""
+        Computes an embedding of the quaternion algebra into the 2x2
+        matrices over a quadratic field.
+
+        Without Magma, the field is `\QQ(\sqrt{a})`, where `a` is the
+        first invariant of the algebra, and `i`, `j` are sent to
+        `\begin{pmatrix}\sqrt{a}&0\\0&-\sqrt{a}\end{pmatrix}` and
+        `\begin{pmatrix}0&b\\1&0\end{pmatrix}`.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,11)
+            sage: X._compute_exact_splitting()
+            sage: B = X.get_eichler_order_basis()
+            sage: all([X.embed_quaternion(Matrix(ZZ,4,1,[1 if t == kk else 0 for t in range(4)]),exact = True).trace() == B[kk].reduced_trace() for kk in range(4)])
+            True
+        """
         self._init_order()
+        if self._use_magma == False:
+            a,b = self._A.invariants()
+            x = PolynomialRing(QQ,'x').gen()
+            self._FF = NumberField(x**2-a,'a')
+            r = self._FF.gen()
+            M = MatrixSpace(self._FF,2,2)
+            I,J = M([r,0,0,-r]),M([0,b,1,0])
+            K = I*J
+            allmats = []
+            for q in self.get_eichler_order_basis():
+                v = q.coefficient_tuple()
+                allmats.append(v[0]+v[1]*I+v[2]*J+v[3]*K)
+            self._Iota_exact=Matrix(self._FF,4,4,[allmats[kk][ii,jj] for ii in range(2) for jj in range(2) for kk in range(4)])
+            return
         self._magma.eval('f:=MatrixRepresentation(R)')
         f=self._magma.function_call('MatrixRepresentation',args=[self._OMaxmagma],nvals=1)
         self._FF=NumberField(f.Codomain().BaseRing().DefiningPolynomial().sage(),'a')
@@ -2952,19 +3699,172 @@ TypeError: mutable matrices are unhashable
             self._OMaxmagma = OMaxmagma
 
         else:
-            # Note that we can't work with non-maximal orders in sage
-            assert self._Nplus == 1
             self._A=QuaternionAlgebra(self._Nminus)
-            v=[1]+self._A.gens()
-            self._O=self._A.maximal_order()
-            self._OMax = self._O
-            OBasis=self._O.basis()
-            self._B=[self._A(OBasis[tt]) for tt in range(4)]
+            self._OMax=self._A.maximal_order()
+            OBasis=self._OMax.basis()
+            if self._Nplus == 1:
+                self._O=self._OMax
+                self._B=[self._A(OBasis[tt]) for tt in range(4)]
+            else:
+                self._B=self._eichler_order_basis(OBasis)
+                self._O=self._A.quaternion_order(self._B)
 
         self._OQuadForm=QuadraticForm(self._Mat_44([(self._B[ii]*self._B[jj].conjugate()).reduced_trace() for ii in range(4) for jj in range(4)]))
         self._OM=self._OQuadForm.matrix()
         self._BB=Matrix(QQ,4,4,[[self._B[ii][jj] for ii in range(4)] for jj in range(4)]).inverse()
 
+    def _eichler_order_basis(self,OBasis):
+        r"""
+        Returns a basis of the Eichler order of level `N^+` contained
+        in the maximal order with basis ``OBasis``.
+
+        An element `x` of the maximal order belongs to the Eichler order
+        if, for each prime power `l^e` exactly dividing `N^+`, the lower
+        left entry of the image of `x` under the splitting returned by
+        :meth:`_local_splitting_at` is divisible by `l^e`. This is a
+        single linear condition modulo `N^+` on the coordinates of `x`.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,7,6)
+            sage: OMax = X.get_maximal_order().basis()
+            sage: B = X.get_eichler_order_basis()
+            sage: abs(Matrix(QQ,4,4,[list(x) for x in B]).determinant()/Matrix(QQ,4,4,[list(x) for x in OMax]).determinant())
+            6
+        """
+        N=self._Nplus
+        residues=[[] for kk in range(4)]
+        moduli=[]
+        for l,e in N.factor():
+            phi=self._local_splitting_map_at(l,e)
+            le=l**e
+            moduli.append(le)
+            for kk in range(4):
+                residues[kk].append(ZZ(phi(OBasis[kk])[1,0].lift())%le)
+        c=[CRT_list(residues[kk],moduli) for kk in range(4)]
+        # The coordinates of the elements of the Eichler order are the
+        # vectors v with sum(v[kk]*c[kk]) divisible by N.
+        K=Matrix(ZZ,5,1,c+[N]).left_kernel().basis_matrix().matrix_from_columns(range(4))
+        return [self._A(sum([K[tt,kk]*OBasis[kk] for kk in range(4)])) for tt in range(4)]
+
+    def _local_splitting_at(self,l,prec):
+        r"""
+        Finds an embedding of the quaternion algebra into the 2x2
+        matrices over `\QQ_l`, for a prime `l` not dividing `N^-`,
+        which sends the maximal order onto `M_2(\ZZ_l)`.
+
+        INPUT:
+
+        - ``l`` - a prime which does not divide the discriminant.
+
+        - ``prec`` - Integer. The precision of the splitting.
+
+        OUTPUT:
+
+        - Matrices I, J, K giving the splitting.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,7)
+            sage: I,J,K = X._local_splitting_at(13,20)
+            sage: J**2 == X.get_quaternion_algebra().invariants()[1]
+            True
+            sage: I*J == -J*I
+            True
+            sage: I,J,K = X._local_splitting_at(2,20)
+            sage: B = X.get_maximal_order().basis()
+            sage: phi = lambda q: sum([x*y for x,y in zip(q.coefficient_tuple(),[1,I,J,K])])
+            sage: all([x.valuation() >= 0 for q in B for x in phi(q).list()])
+            True
+            sage: I**2 == X.get_quaternion_algebra().invariants()[0]
+            True
+        """
+        A=self.get_quaternion_algebra()
+        if self._Nminus % l == 0:
+            raise ValueError, "l (=%s) must be an unramified prime"%l
+        Ql=Qp(l,prec)
+        a,b=[Ql(x) for x in A.invariants()]
+        M=MatrixSpace(Ql,2,2)
+        if a.is_square():
+            alpha=a.sqrt()
+            I=M([alpha,0,2*alpha,-alpha])
+            J=M([b,-b,b-1,-b])
+        else:
+            I=M([0,a,1,0])
+            # We need z with a*z^2+b = x^2 (or x = 0 if -b/a is a
+            # square). Write a = l^(2sa)*a0 and b = l^(2sb)*b0 with a0,
+            # b0 of valuation 0 or 1. Since the algebra splits at l,
+            # either z = 0 works or some z = t*l^(sb-sa) with 0 < t < l
+            # does when l is odd: a*z^2+b = l^(2sb)*(a0*t^2+b0) is then a
+            # square as soon as a0*t^2+b0 is a nonzero square mod l. For l = 2 one
+            # of t in {1,3,5,7} times 2^(sb-sa+k), with k in {-1,0,1},
+            # works: checking the 64 square classes of (a0,b0) suffices.
+            # The square root is Hensel-lifted by sqrt.
+            sa=a.valuation()//2
+            sb=b.valuation()//2
+            if (-b/a).is_square():
+                z=(-b/a).sqrt()
+                x=0
+            else:
+                if l == 2:
+                    candidates=[t*QQ(2)**(sb-sa+k) for k in [0,-1,1] for t in [1,3,5,7]]
+                else:
+                    candidates=[t*QQ(l)**(sb-sa) for t in range(1,l)]
+                x=None
+                for z in [0]+candidates:
+                    c=a*z*z+b
+                    if c.is_square():
+                        x=c.sqrt()
+                        break
+                if x is None:
+                    raise ValueError, "the quaternion algebra ramifies at %s"%l
+            J=M([x,-a*z,z,-x])
+        K=I*J
+        def phi(q):
+            v=q.coefficient_tuple()
+            return v[0]+v[1]*I+v[2]*J+v[3]*K
+        # The image of the maximal order is the endomorphism ring of the
+        # lattice spanned by the images of the first basis vector. We
+        # conjugate by a basis of this lattice.
+        W=[phi(q).column(0) for q in self.get_maximal_order().basis()]
+        u1=min([w for w in W if w[0] != 0],key = lambda w:w[0].valuation())
+        W=[w-(w[0]/u1[0])*u1 for w in W]
+        u2=min([w for w in W if w[1] != 0],key = lambda w:w[1].valuation())
+        g=M([u1[0],u2[0],u1[1],u2[1]])
+        ginv=g.inverse()
+        return ginv*I*g,ginv*J*g,ginv*K*g
+
+    def _local_splitting_map_at(self,l,e = 1):
+        r"""
+        Returns a function which sends a quaternion to its image under
+        the splitting at `l`, with enough precision to be reduced
+        modulo `l^e`. See :meth:`_local_splitting_at`.
+
+        The splittings are cached.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,7)
+            sage: phi = X._local_splitting_map_at(3)
+            sage: B.<i,j,k> = X.get_quaternion_algebra()
+            sage: phi(i*j) == phi(i)*phi(j)
+            True
+        """
+        try: splittings=self._local_splittings
+        except AttributeError: splittings=self._local_splittings=dict()
+        prec=2*e+20
+        try:
+            I,J,K=splittings[l]
+            if I.base_ring().precision_cap() < prec:
+                raise KeyError
+        except KeyError:
+            I,J,K=self._local_splitting_at(l,prec)
+            splittings[l]=(I,J,K)
+        def phi(q):
+            v=q.coefficient_tuple()
+            return v[0]+v[1]*I+v[2]*J+v[3]*K
+        return phi
+
     def B_one(self):
         r""" 
         Returns the coordinates of `1` in the basis for the
@@ -3019,7 +3919,6 @@ TypeError: mutable matrices are unhashable
         B = self.get_eichler_order_basis()
         return sum([v[i]*B[i] for i in range(4)])
 
-    @cached_method
     def _find_elements_in_order(self, norm, trace = None, primitive=False):
         r""" Returns elements in the order of the quaternion algebra
         of specified reduced norm. One may optionally choose to
@@ -3035,25 +3934,359 @@ TypeError: mutable matrices are unhashable
         - ``primitive`` boolean (Default: False). If True, return only
         elements that cannot be divided by `p`.
 
+        OUTPUT:
+
+        A list of tuples, the coordinates of the elements in the basis
+        of the Eichler order.
+
         EXAMPLES:
 
             sage: X = BTQuotient(5,7)
             sage: X._find_elements_in_order(23)
-            [[2, 9, -1, -5], [0, 8, 0, -5], [-2, 9, 1, -5], [6, 7, -3, -4], [2, 5, -1, -4], [0, 6, -1, -4], [0, 8, -1, -4], [2, 9, -1, -4], [-2, 5, 1, -4], [0, 6, 1, -4], [0, 8, 1, -4], [-2, 9, 1, -4], [-6, 7, 3, -4], [7, 6, -4, -3], [7, 6, -3, -3], [6, 7, -3, -3], [0, 8, 0, -3], [-7, 6, 3, -3], [-6, 7, 3, -3], [-7, 6, 4, -3], [0, 1, -1, -2], [0, 6, -1, -2], [0, 1, 1, -2], [0, 6, 1, -2], [9, 2, -5, -1], [6, 0, -4, -1], [8, 0, -4, -1], [5, 2, -4, -1], [9, 2, -4, -1], [1, 0, -2, -1], [6, 0, -2, -1], [0, -1, -1, -1], [-1, 0, -1, -1], [5, 2, -1, -1], [2, 5, -1, -1], [0, -1, 1, -1], [1, 0, 1, -1], [-5, 2, 1, -1], [-2, 5, 1, -1], [-6, 0, 2, -1], [-1, 0, 2, -1], [-8, 0, 4, -1], [-6, 0, 4, -1], [-9, 2, 4, -1], [-5, 2, 4, -1], [-9, 2, 5, -1], [8, 0, -5, 0], [8, 0, -3, 0]]
+            [(2, 9, -1, -5), (0, 8, 0, -5), (-2, 9, 1, -5), (6, 7, -3, -4), (2, 5, -1, -4), (0, 6, -1, -4), (0, 8, -1, -4), (2, 9, -1, -4), (-2, 5, 1, -4), (0, 6, 1, -4), (0, 8, 1, -4), (-2, 9, 1, -4), (-6, 7, 3, -4), (7, 6, -4, -3), (7, 6, -3, -3), (6, 7, -3, -3), (0, 8, 0, -3), (-7, 6, 3, -3), (-6, 7, 3, -3), (-7, 6, 4, -3), (0, 1, -1, -2), (0, 6, -1, -2), (0, 1, 1, -2), (0, 6, 1, -2), (9, 2, -5, -1), (6, 0, -4, -1), (8, 0, -4, -1), (5, 2, -4, -1), (9, 2, -4, -1), (1, 0, -2, -1), (6, 0, -2, -1), (0, -1, -1, -1), (-1, 0, -1, -1), (5, 2, -1, -1), (2, 5, -1, -1), (0, -1, 1, -1), (1, 0, 1, -1), (-5, 2, 1, -1), (-2, 5, 1, -1), (-6, 0, 2, -1), (-1, 0, 2, -1), (-8, 0, 4, -1), (-6, 0, 4, -1), (-9, 2, 4, -1), (-5, 2, 4, -1), (-9, 2, 5, -1), (8, 0, -5, 0), (8, 0, -3, 0)]
+            sage: X._find_elements_in_order(23,1)
+            [(1, 0, -2, -1), (1, 0, 1, -1)]
+
+        The vectors of all norms up to the largest norm requested so far
+        are kept, as long as there are at most ``NORM_FORM_CACHE_SIZE``
+        of them, so that smaller norms do not need a new enumeration::
+
+            sage: X._norm_form_bound
+            23
+            sage: X._find_elements_in_order(1) == [tuple(v) for v in X.get_eichler_order_quadform().vectors_by_length(1)[1]]
+            True
+            sage: X._norm_form_bound
+            23
+
+        The vectors are returned as tuples, in a new list, so modifying
+        the list does not affect the cache::
+
+            sage: W = X._find_elements_in_order(23,1)
+            sage: W.pop()
+            (1, 0, 1, -1)
             sage: X._find_elements_in_order(23,1)
-            [[1, 0, -2, -1], [1, 0, 1, -1]]
+            [(1, 0, -2, -1), (1, 0, 1, -1)]
+            sage: X._clear_norm_form_cache()
+            sage: X._norm_form_bound
+            -1
         """
-        OQuadForm=self.get_eichler_order_quadform()
-        if norm > 10^3:
-            print 'Warning: norm (= %s) is quite large, this may take some time!'%norm
-        V=OQuadForm.vectors_by_length(norm)[norm]
-        W=V if not primitive else filter(lambda v: any((vi%self._p != 0 for vi in v)),V)
-        return W if trace is None else filter(lambda v:self._conv(v).reduced_trace() == trace,W)
+        key=(norm,trace,primitive)
+        try:
+            return list(self._norm_form_index[key])
+        except AttributeError:
+            self._clear_norm_form_cache()
+        except KeyError: pass
+
+        if trace is not None:
+            traces=[x.reduced_trace() for x in self.get_eichler_order_basis()]
+            W=filter(lambda v:sum([vi*ti for vi,ti in zip(v,traces)]) == trace,self._find_elements_in_order(norm,primitive = primitive))
+        elif primitive:
+            W=filter(lambda v: any((vi%self._p != 0 for vi in v)),self._find_elements_in_order(norm))
+        else:
+            if norm > self._norm_form_bound:
+                if norm > 10**3:
+                    print 'Warning: norm (= %s) is quite large, this may take some time!'%norm
+                V=self.get_eichler_order_quadform().vectors_by_length(norm)
+                if sum([len(Vn) for Vn in V]) > NORM_FORM_CACHE_SIZE:
+                    self._clear_norm_form_cache()
+                    return [tuple(v) for v in V[norm]]
+                for n in range(self._norm_form_bound+1,norm+1):
+                    self._norm_form_vectors[n]=[tuple(v) for v in V[n]]
+                self._norm_form_bound=norm
+            W=self._norm_form_vectors[norm]
+        if norm <= self._norm_form_bound:
+            self._norm_form_index[key]=W
+        return list(W)
+
+    def _clear_norm_form_cache(self):
+        r"""
+        Empties the cache of vectors of the norm form used by
+        :meth:`_find_elements_in_order`.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(5,7)
+            sage: len(X._find_elements_in_order(23))
+            48
+            sage: X._clear_norm_form_cache()
+            sage: X._norm_form_index
+            {}
+        """
+        self._norm_form_index=dict()
+        self._norm_form_vectors=dict()
+        self._norm_form_bound=-1
+
+    def _cache_file(self, name):
+        r"""
+        Returns the name of the file where the data called ``name`` is
+        stored, or None if the on-disk cache is disabled.
+
+        The file name only depends on ``name``, `p`, `N^-`, `N^+`, the
+        character and whether Magma is used, so that different sessions
+        share the same file. The cache is disabled by default, and is
+        enabled by setting ``BTQUOTIENT_CACHE_DIR`` to a directory.
+
+        EXAMPLES::
+
+            sage: import sage.modular.btquotients.btquotient as btquotient
+            sage: X = BTQuotient(5,13)
+            sage: X._cache_file('quotient') is None
+            True
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = tmp_dir()
+            sage: X._cache_file('quotient').endswith('quotient_5_13_1_trivial_sage.sobj')
+            True
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = None
+        """
+        if BTQUOTIENT_CACHE_DIR is None:
+            return None
+        if self._character.is_trivial():
+            chi = 'trivial'
+        else:
+            chi = hashlib.md5(str(self._character.values_on_gens())).hexdigest()[:16]
+        backend = 'magma' if self._use_magma else 'sage'
+        name = '%s_%s_%s_%s_%s_%s.sobj'%(name,self._p,self._Nminus,self._Nplus,chi,backend)
+        return os.path.join(BTQUOTIENT_CACHE_DIR,name)
 
-    def _compute_quotient(self, use_formulas = True):
+    def _write_cache_data(self, name, data):
+        r"""
+        Stores the dictionary ``data`` in the file given by
+        :meth:`_cache_file`. Returns True if the data could be written.
+
+        The basis of the Eichler order is stored along with the data,
+        since quaternions are given in coordinates with respect to it,
+        and so is the embedding into `M_2(\QQ_p)` modulo the current
+        precision (see :meth:`_embedding_data`), since the vertices and
+        edges depend on it.
+
+        EXAMPLES::
+
+            sage: import sage.modular.btquotients.btquotient as btquotient
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = tmp_dir()
+            sage: X = BTQuotient(5,13)
+            sage: X._write_cache_data('test',{'a':1})
+            True
+            sage: X._read_cache_data('test')['a']
+            1
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = None
+            sage: X._write_cache_data('test',{'a':1})
+            False
+        """
+        filename = self._cache_file(name)
+        if filename is None:
+            return False
+        data = dict(data)
+        data['version'] = _QUOTIENT_CACHE_VERSION
+        data['basis'] = [list(x) for x in self.get_eichler_order_basis()]
+        prec = max(self._prec,1)
+        data['embedding'] = (prec,self._embedding_data(prec))
+        try:
+            if not os.path.isdir(BTQUOTIENT_CACHE_DIR):
+                os.makedirs(BTQUOTIENT_CACHE_DIR)
+            tmpname = '%s.%s.tmp'%(filename,os.getpid())
+            fp = open(tmpname,'wb')
+            try:
+                fp.write(dumps(data))
+            finally:
+                fp.close()
+            os.rename(tmpname,filename)
+        except (IOError,OSError):
+            return False
+        return True
+
+    def _read_cache_data(self, name):
+        r"""
+        Returns the dictionary stored by :meth:`_write_cache_data`, or
+        None if there is no usable data on disk (for example, if it was
+        computed with a different basis for the Eichler order or with a
+        different embedding).
+
+        EXAMPLES::
+
+            sage: import sage.modular.btquotients.btquotient as btquotient
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = tmp_dir()
+            sage: X = BTQuotient(5,13)
+            sage: X._read_cache_data('nonexistent') is None
+            True
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = None
+        """
+        filename = self._cache_file(name)
+        if filename is None or not os.path.exists(filename):
+            return None
+        try:
+            fp = open(filename,'rb')
+            try:
+                data = loads(fp.read())
+            finally:
+                fp.close()
+        except Exception:
+            return None
+        if data.get('version') != _QUOTIENT_CACHE_VERSION:
+            return None
+        if data['basis'] != [list(x) for x in self.get_eichler_order_basis()]:
+            return None
+        prec,embedding = data['embedding']
+        if embedding != self._embedding_data(prec):
+            return None
+        return data
+
+    def _embedding_data(self, prec):
+        r"""
+        Returns the entries of the embedding matrix (see
+        :meth:`get_embedding_matrix`) modulo `p^{prec}`, as a list of
+        integers.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(7,2)
+            sage: X._embedding_data(4) == [ZZ(x.lift()) % 7**4 for x in X.get_embedding_matrix(4).list()]
+            True
+        """
+        pN = self._p**prec
+        return [ZZ(x.lift()) % pN for x in self.get_embedding_matrix(prec = prec).list()]
+
+    def _save_quotient_data(self):
+        r"""
+        Stores the quotient graph on disk, as plain lists of
+        integers. Returns True if the data could be written.
+
+        EXAMPLES::
+
+            sage: import sage.modular.btquotients.btquotient as btquotient
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = tmp_dir()
+            sage: X = BTQuotient(5,13)
+            sage: X.get_graph()
+            Multi-graph on 2 vertices
+            sage: X._save_quotient_data()
+            True
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = None
+        """
+        vertex_list = self._vertex_list
+        edge_list = self._edge_list
+        ## Every label is shared by an edge in edge_list and its
+        ## opposite, which we tell apart by a flag.
+        flag = lambda e: 0 if e is edge_list[e.label] else 1
+        links = lambda e: [(g.list(),m) for g,m in e.links]
+        data = dict()
+        data['vertices'] = [(v.rep.list(),v.determinant,v.valuation) for v in vertex_list]
+        data['edges'] = [(e.rep.list(),e.origin.label,e.target.label,e.determinant,e.valuation,links(e),e.opposite.rep.list(),e.opposite.determinant,e.opposite.valuation,links(e.opposite)) for e in edge_list]
+        data['leaving'] = [[(e.label,flag(e)) for e in v.leaving_edges] for v in vertex_list]
+        data['entering'] = [[(e.label,flag(e)) for e in v.entering_edges] for v in vertex_list]
+        data['generators'] = [g.list() for g in self._generators]
+        data['Sfun'] = [(a.list(),b.list(),lab) for a,b,lab in self._Sfun.edges()]
+        data['Sfun_vertices'] = [(w.list(),x.label) for w,x in self._Sfun.get_vertices().iteritems() if x is not None]
+        return self._write_cache_data('quotient',data)
+
+    def _load_quotient_data(self):
+        r"""
+        Reads the quotient graph stored by :meth:`_save_quotient_data`
+        and rebuilds the vertices, edges and graphs from it. Returns
+        True on success, and False if there is no usable data on disk
+        (for example, if it was computed with a different basis for
+        the Eichler order).
+
+        EXAMPLES::
+
+            sage: import sage.modular.btquotients.btquotient as btquotient
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = tmp_dir()
+            sage: X = BTQuotient(5,13)
+            sage: X.get_graph()
+            Multi-graph on 2 vertices
+            sage: X._save_quotient_data()
+            True
+            sage: X._load_quotient_data()
+            True
+            sage: X.get_graph()
+            Multi-graph on 2 vertices
+            sage: btquotient.BTQUOTIENT_CACHE_DIR = None
+        """
+        data = self._read_cache_data('quotient')
+        if data is None:
+            return False
+
+        def mat22(x):
+            m = self._Mat_22(x)
+            m.set_immutable()
+            return m
+        def mat41(x):
+            m = self._Mat_41(x)
+            m.set_immutable()
+            return m
+
+        vertex_list = [Vertex(self,i,mat22(rep),determinant = det,valuation = val) for i,(rep,det,val) in enumerate(data['vertices'])]
+        edges = []
+        for label,(rep,o,t,det,val,lk,orep,odet,oval,olk) in enumerate(data['edges']):
+            v,v1 = vertex_list[o],vertex_list[t]
+            e = Edge(self,label,mat22(rep),v,v1,links = [(mat41(g),m) for g,m in lk],determinant = det,valuation = val)
+            eo = Edge(self,label,mat22(orep),v1,v,links = [(mat41(g),m) for g,m in olk],opposite = e,determinant = odet,valuation = oval)
+            e.opposite = eo
+            edges.append((e,eo))
+        for v,lv,ev in zip(vertex_list,data['leaving'],data['entering']):
+            v.leaving_edges.extend([edges[i][j] for i,j in lv])
+            v.entering_edges.extend([edges[i][j] for i,j in ev])
+
+        S = Graph(0,multiedges=True,weighted=True)
+        for v in vertex_list:
+            S.add_vertex(v.rep)
+            S.set_vertex(v.rep,v)
+        for e,eo in edges:
+            S.add_edge(e.origin.rep,e.target.rep,e.label)
+        Sfun = Graph(0)
+        for a,b,label in data['Sfun']:
+            Sfun.add_edge(mat22(a),mat22(b),label = label)
+        for w,label in data['Sfun_vertices']:
+            Sfun.set_vertex(mat22(w),vertex_list[label])
+
+        self._generators = set([mat41(g) for g in data['generators']])
+        self._boundary = dict([(v.rep,v) for v in vertex_list])
+        self._boundary_nf = dict([(self._BT._entries(v.rep),v) for v in vertex_list])
+        self._edge_list = [e for e,eo in edges]
+        self._vertex_list = vertex_list
+        self._num_edges = len(edges)
+        self._S = S
+        self._Sfun = Sfun
+        return True
+
+    def _prefetch_frontier(self, frontier, ncpus):
+        r"""
+        Runs in parallel the equivalence tests needed to expand the
+        vertices in ``frontier``, and stores the results in the caches
+        of fingerprints and equivalences.
+
+        The tests for each vertex are done against the state of the
+        graph at the beginning of the level, so a few of them may still
+        have to be done by :meth:`_compute_quotient` when it commits
+        the new edges and vertices, in order.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(17,19)
+            sage: X._compute_quotient(use_cache = False, ncpus = 2)
+            sage: X.get_graph()
+            Multi-graph on 4 vertices
+        """
+        from sage.parallel.decorate import parallel
+        job = parallel(ncpus=ncpus)(_quotient_frontier_job)
+        frontier = list(frontier)
+        inputs = [(self,v,frontier[i+1:]) for i,v in enumerate(frontier)]
+        for (args,kwds),res in job(inputs):
+            fps,eqs = res
+            self._cached_fingerprints.update(fps)
+            self._cached_equivalent.update(eqs)
+
+    def _compute_quotient(self, use_formulas = True, use_cache = True, ncpus = None):
         r"""
         Computes the quotient graph.
 
+        If ``use_cache`` is True (default), the graph is first looked
+        up in ``BTQUOTIENT_CACHE_DIR``, and stored there once it has
+        been computed. This does nothing unless a directory has been
+        assigned to ``BTQUOTIENT_CACHE_DIR``, which is None by default.
+
+        If ``ncpus`` is given, the equivalence tests of each level of
+        the breadth-first search are run in parallel with that many
+        processes (see :meth:`_prefetch_frontier`). The resulting graph
+        is the same as the one obtained sequentially.
+
         EXAMPLES::
 
             sage: X = BTQuotient(11,2)
@@ -3097,6 +4330,8 @@ TypeError: mutable matrices are unhashable
         num_edges=0
         self.get_extra_embedding_matrices()
         self.get_embedding_matrix(prec = 1)
+        if use_cache and self._load_quotient_data():
+            return
         p=self._p
         v0=Vertex(self,num_verts,self._Mat_22([1,0,0,1]),determinant = 1,valuation = 0)
         V=collections.deque([v0])
@@ -3108,7 +4343,12 @@ TypeError: mutable matrices are unhashable
         num_verts+=1
         total_verts = self.get_num_verts()
         total_edges = genus + total_verts -1
+        level_left = 0
         while len(V)>0:
+            if ncpus is not None and level_left == 0:
+                level_left = len(V)
+                self._prefetch_frontier(V,ncpus)
+            level_left -= 1
             v=V.popleft()
             E=self._BT.leaving_edges(v.rep)
 
@@ -3184,8 +4424,11 @@ TypeError: mutable matrices are unhashable
 
         self._generators = generators
         self._boundary = dict([(v.rep,v) for v in vertex_list])
+        self._boundary_nf = dict([(self._BT._entries(v.rep),v) for v in vertex_list])
         self._edge_list = edge_list
         self._vertex_list = vertex_list
         self._num_edges = num_edges
         self._S = S
         self._Sfun = Sfun
+        if use_cache:
+            self._save_quotient_data()
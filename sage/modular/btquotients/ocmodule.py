@@ -13,8 +13,101 @@ from sage.matrix.matrix_space import MatrixSpace
 from copy import copy
 from sage.rings.finite_rings.integer_mod_ring import Zmod
 from sage.rings.all import Integer
+from sage.rings.arith import inverse_mod
 from sage.rings.power_series_ring import PowerSeriesRing
 from sage.structure.unique_representation import UniqueRepresentation
+import collections
+
+## Maximum number of action matrices cached by each OCVn. Set it to
+## None to keep all of them.
+OCVN_POWERS_CACHE_SIZE = 2000
+
+class _PowersCache(object):
+    r"""
+    A dictionary of bounded size, used to cache the action matrices of
+    an :class:`OCVn`. When it is full, the least recently used entry is
+    discarded. It counts the lookups that succeed and fail.
+
+    INPUT:
+
+     - ``maxsize`` - integer or None (default: None). The maximum number
+       of entries. If None, the size is not bounded.
+
+    EXAMPLES::
+
+        sage: from sage.modular.btquotients.ocmodule import _PowersCache
+        sage: C = _PowersCache(2)
+        sage: C[1] = 'a'; C[2] = 'b'
+        sage: C[1]
+        'a'
+        sage: C[3] = 'c'
+        sage: 1 in C, 2 in C, 3 in C
+        (True, False, True)
+        sage: C[2]
+        Traceback (most recent call last):
+        ...
+        KeyError: 2
+        sage: sorted(C.stats().items())
+        [('hits', 1), ('maxsize', 2), ('misses', 1), ('size', 2)]
+    """
+    def __init__(self,maxsize=None):
+        self._data=collections.OrderedDict()
+        self.maxsize=maxsize
+        self.hits=0
+        self.misses=0
+
+    def __getitem__(self,key):
+        try:
+            value=self._data.pop(key)
+        except KeyError:
+            self.misses+=1
+            raise
+        self._data[key]=value
+        self.hits+=1
+        return value
+
+    def __setitem__(self,key,value):
+        self._data.pop(key,None)
+        self._data[key]=value
+        if self.maxsize is not None:
+            while len(self._data)>self.maxsize:
+                self._data.popitem(last=False)
+
+    def __contains__(self,key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        r"""
+        Empties the cache and resets the statistics.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import _PowersCache
+            sage: C = _PowersCache()
+            sage: C[1] = 'a'; x = C[1]
+            sage: C.clear(); len(C), C.hits
+            (0, 0)
+        """
+        self._data.clear()
+        self.hits=0
+        self.misses=0
+
+    def stats(self):
+        r"""
+        Returns a dictionary with the number of hits and misses, the
+        current size and the maximum size of the cache.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import _PowersCache
+            sage: C = _PowersCache(10)
+            sage: sorted(C.stats().items())
+            [('hits', 0), ('maxsize', 10), ('misses', 0), ('size', 0)]
+        """
+        return {'hits':self.hits,'misses':self.misses,'size':len(self._data),'maxsize':self.maxsize}
 
 class OCVnElement(ModuleElement):
     r"""
@@ -180,19 +273,30 @@ class OCVnElement(ModuleElement):
         ::
 
         """
-        R=self._parent._R
-        if(self._parent.base_ring().is_exact()):
-            factor=1
-        else:
-            t=min([R(x).valuation() for x in [a,b,c,d] if x!=0])
-            factor=R.prime()**(-t)
-        try:
-            x=self._parent._powers[(factor*a,factor*b,factor*c,factor*d)]
-            return self.__class__(self._parent,(extrafactor*factor**(-self._n))*(x*self._val),quick=True)
-        except KeyError:
-            tmp=self._parent._get_powers_and_mult(factor*a,factor*b,factor*c,factor*d,extrafactor*factor**(-self._n),self._val)
+        key,factor=self._parent._action_key(a,b,c,d)
+        return self._act_by_data((key,extrafactor*factor**(-self._n)))
+
+    def _act_by_data(self,data):
+        r"""
+        Returns the result of acting on ``self`` by a matrix, given the
+        data returned by :meth:`OCVn._l_action_data` or
+        :meth:`OCVn._r_action_data` for it.
+
+        This allows to normalize the matrices which are used
+        repeatedly only once.
 
-            return self.__class__(self._parent,tmp,quick=True)
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import OCVn
+            sage: V = OCVn(2,Qp(5,10))
+            sage: g = Matrix(ZZ,2,2,[1,2,5,3])
+            sage: v = V.basis()[1]
+            sage: v._act_by_data(V._l_action_data(g)) == v.l_act_by(g)
+            True
+        """
+        key,scale=data
+        x=self._parent._get_action_matrix(key)
+        return self.__class__(self._parent,self._parent._R(scale)*(x*self._val),quick=True)
 
     def _rmul_(self,a):
         r"""
@@ -367,7 +471,7 @@ class OCVn(Module,UniqueRepresentation):
             if R.is_exact(): raise ValueError, "Trying to construct an over-convergent module with exact coefficients, how do you store p-adics ??"
         self._depth=depth
         self._PowerSeries=PowerSeriesRing(self._Rmod,default_prec=self._depth,name='z')
-        self._powers=dict()
+        self._powers=_PowersCache(OCVN_POWERS_CACHE_SIZE)
         self._populate_coercion_lists_()
 
     def _an_element_(self):
@@ -396,6 +500,86 @@ class OCVn(Module,UniqueRepresentation):
         #Admissible values of x?
         return OCVnElement(self,x)
 
+    def _action_key(self,a,b,c,d):
+        r"""
+        Returns the key under which the action matrix of
+        `\begin{pmatrix}a&b\\c&d\end{pmatrix}` is cached, and the
+        power of `p` by which the matrix was scaled to make it primitive.
+
+        Over `p`-adic rings the key consists of the integer
+        representatives modulo `p^N` of the scaled entries, where `N`
+        is the precision cap, so that equal matrices always give the
+        same key.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import OCVn
+            sage: V = OCVn(2,Qp(5,10))
+            sage: V._action_key(5,10,25,-5)
+            ((1, 2, 5, 9765624), 1/5)
+        """
+        R=self._R
+        if R.is_exact():
+            return (a,b,c,d),1
+        t=min([R(x).valuation() for x in [a,b,c,d] if x!=0])
+        factor=R.prime()**(-t)
+        Rmod=self._Rmod
+        return tuple([Rmod(factor*x).lift() for x in [a,b,c,d]]),factor
+
+    def _l_action_data(self,g):
+        r"""
+        Returns the data needed to act on the left by the matrix ``g``,
+        to be passed to :meth:`OCVnElement._act_by_data`.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import OCVn
+            sage: V = OCVn(2,Qp(5,10))
+            sage: V._l_action_data(Matrix(ZZ,2,2,[1,2,5,3]))
+            ((1, 2, 5, 3), -1/7)
+        """
+        key,factor=self._action_key(g[0,0],g[0,1],g[1,0],g[1,1])
+        return key,g.determinant()**(-Integer(self._n/2))*factor**(-self._n)
+
+    def _r_action_data(self,g):
+        r"""
+        Returns the data needed to act on the right by the matrix ``g``,
+        to be passed to :meth:`OCVnElement._act_by_data`.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import OCVn
+            sage: V = OCVn(2,Qp(5,10))
+            sage: g = Matrix(ZZ,2,2,[1,2,5,3])
+            sage: v = V.basis()[0]
+            sage: v._act_by_data(V._r_action_data(g)) == v.r_act_by(g)
+            True
+        """
+        key,factor=self._action_key(g[1,1],-g[0,1],-g[1,0],g[0,0])
+        return key,g.determinant()**(-Integer(self._n/2))*factor**(-self._n)
+
+    def _get_action_matrix(self,key):
+        r"""
+        Returns the action matrix for the key returned by
+        :meth:`_action_key`, computing it if it is not cached.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import OCVn
+            sage: V = OCVn(2,Qp(5,10))
+            sage: V._powers.clear()
+            sage: x = V._get_action_matrix((1,2,5,3))
+            sage: x = V._get_action_matrix((1,2,5,3))
+            sage: V._powers.hits, V._powers.misses
+            (1, 1)
+        """
+        try:
+            return self._powers[key]
+        except KeyError:
+            x=self._compute_powers(*key)
+            self._powers[key]=x
+            return x
+
     def _get_powers_and_mult(self,a,b,c,d,lambd,vect):
         r"""
         Compute the action of a matrix on the basis elements.
@@ -405,38 +589,100 @@ class OCVn(Module,UniqueRepresentation):
         ::
 
         """
-        R=self._PowerSeries
-        r=R([b,a])
-        s=R([d,c])
+        x=self._get_action_matrix(self._action_key(a,b,c,d)[0])
+        return self._R(lambd)*x*vect
+
+    def _compute_powers(self,a,b,c,d):
+        r"""
+        Returns the matrix of the action of
+        `\begin{pmatrix}a&b\\c&d\end{pmatrix}` on the basis, where
+        the entries are primitive.
+
+        EXAMPLES::
+
+            sage: from sage.modular.btquotients.ocmodule import OCVn
+            sage: V = OCVn(2,QQ)
+            sage: V._compute_powers(1,2,5,3)
+            [ 9 30 25]
+            [ 6 13  5]
+            [ 4  4  1]
+            sage: V._compute_powers(1,2,5,0)
+            [ 0  0 25]
+            [ 0 10  5]
+            [ 4  4  1]
+
+        Over `p`-adic rings the computations are done with the integer
+        representatives modulo `p^N`::
+
+            sage: V = OCVn(3,Qp(5,10),6)
+            sage: x = V._compute_powers(1,2,5,3)
+            sage: R.<z> = PowerSeriesRing(Zmod(5^10),default_prec = 6)
+            sage: y = [(2+z)^i*(3+5*z)^3/(3+5*z)^i for i in range(6)]
+            sage: x == Matrix(Qp(5,10),6,6,[ZZ(t) for f in y for t in f.padded_list(6)])
+            True
+        """
+        depth=self._depth
         n=self._n
-        if(self._depth==n+1):
-            rpows=[R(1)]
-            spows=[R(1)]
-            for ii in range(n):
-                rpows.append(r*rpows[ii])
-                spows.append(s*spows[ii])
-            x=Matrix(self._Rmod,n+1,n+1,0)
-            for ii in range(n+1):
-                y=rpows[ii]*spows[n-ii]
-                for jj in range(self._depth):
-                    x[ii,jj]=y[jj]
-        else:
-            ratio=r*(s**(-1))
-            y=s**n
-            x=Matrix(self._Rmod,self._depth,self._depth,0)
-            for jj in range(self._depth):
-                x[0,jj]=y[jj]
-            for ii in range(1,self._depth):
-                y*=ratio
-                for jj in range(self._depth):
-                    x[ii,jj]=y[jj]
         if self._Rmod is self._R:
-            xnew=x
+            a,b,c,d=[self._R(t) for t in [a,b,c,d]]
+            M=None
+            unit=(d!=0)
         else:
-            xnew=x.change_ring(self._R.base_ring())
-            xnew=xnew.change_ring(self._R)
-        self._powers[(a,b,c,d)]=xnew
-        return self._R(lambd)*xnew*vect
+            # Work with the integer representatives modulo p^N, which
+            # fit in machine words for the usual precisions.
+            Rmod=self._Rmod
+            M=int(Rmod.order())
+            a,b,c,d=[int(Rmod(t).lift()) for t in [a,b,c,d]]
+            unit=(d%self._R.prime()!=0)
+
+        def mul_linear(y,u,v):
+            # y*(u+v*z), truncated at depth
+            z=[u*y[0]]+[u*y[k]+v*y[k-1] for k in range(1,depth)]
+            return z if M is None else [t%M for t in z]
+
+        def div_linear(y,u_inv,v):
+            # y/(u+v*z), truncated at depth, where u_inv = 1/u
+            z=[y[0]*u_inv]
+            for k in range(1,depth):
+                z.append((y[k]-v*z[k-1])*u_inv)
+                if M is not None:
+                    z[k]%=M
+            if M is not None:
+                z[0]%=M
+            return z
+
+        one=[1]+[0]*(depth-1)
+        if unit:
+            # Row ii+1 is row ii times (b+az)/(d+cz), which only costs
+            # O(depth) operations per row.
+            d_inv=1/d if M is None else int(inverse_mod(d,M))
+            y=one
+            for ii in range(n):
+                y=mul_linear(y,d,c)
+            rows=[y]
+            for ii in range(1,depth):
+                y=div_linear(mul_linear(y,b,a),d_inv,c)
+                rows.append(y)
+        else:
+            if depth != n+1:
+                raise ZeroDivisionError, "d (=%s) must be a unit"%d
+            # Here depth == n+1, and the rows are the polynomials
+            # (b+az)^ii*(d+cz)^(n-ii).
+            rpows=[one]
+            spows=[one]
+            for ii in range(n):
+                rpows.append(mul_linear(rpows[ii],b,a))
+                spows.append(mul_linear(spows[ii],d,c))
+            rows=[]
+            for ii in range(n+1):
+                u,v=rpows[ii],spows[n-ii]
+                y=[sum([u[k]*v[jj-k] for k in range(jj+1)]) for jj in range(depth)]
+                rows.append(y if M is None else [t%M for t in y])
+        if M is None:
+            return Matrix(self._R,depth,depth,[t for y in rows for t in y])
+        R=self._R
+        N=R.precision_cap()
+        return Matrix(R,depth,depth,[R(t,absprec=N) for y in rows for t in y])
 
     def _repr_(self):
         r"""
@@ -14,13 +14,16 @@ from sage.modules.module import Module
 from sage.rings.all import Integer
 from sage.structure.element import Element
 from sage.matrix.constructor import Matrix, zero_matrix
+from sage.modules.free_module_element import vector
 from sage.rings.all import Qp
 from sage.rings.all import RationalField
 from sage.rings.number_field.all import NumberField
 from copy import copy
+import sys
 from sage.quadratic_forms.quadratic_form import QuadraticForm
 from sage.rings.polynomial.polynomial_ring_constructor import PolynomialRing
 from sage.rings.laurent_series_ring import LaurentSeriesRing
+from sage.rings.power_series_ring import PowerSeriesRing
 from sage.modular.hecke.all import (AmbientHeckeModule, HeckeSubmodule, HeckeModuleElement)
 from sage.rings.infinity import Infinity
 import sage.rings.arith as arith
@@ -205,6 +208,98 @@ class BTMap(object):
             D[ky] = self(gamma*ky) * gamma
         return self.__class__(self._codomain, self._manin, D, check=False)
 
+def _modular_form_values(BT,forms,points,level,n,depth,moments):
+    r"""
+    Returns the matrix whose `(i,j)` entry is the value at
+    ``points[j]`` of the rigid modular form attached to ``forms[i]``.
+
+    The points are grouped by the affinoid containing them, so that
+    the covering of `\PP^1(\QQ_p)` by balls, and the values of the
+    forms on them, are computed once for each affinoid. For each ball
+    `e` and point `z`, the first ``depth`` Taylor coefficients of the
+    kernel `1/(x-z)` pulled back by `e` are put in a matrix, and the
+    values are then the product of this matrix with the matrix of
+    moments.
+
+    INPUT:
+
+    - ``BT`` - a Bruhat-Tits tree.
+    - ``forms`` - a list of harmonic cocycles or `p`-adic automorphic forms.
+    - ``points`` - a list of points in the `p`-adic upper half plane,
+      in the same field.
+    - ``level`` - integer. The level of the covering.
+    - ``n`` - integer. The weight of the coefficient module.
+    - ``depth`` - integer. The number of moments used.
+    - ``moments`` - a function which given a form and an edge returns
+      the list of the first ``depth`` moments of the form on it.
+    """
+    K = points[0].parent()
+    PS = PowerSeriesRing(K,'r',default_prec = depth)
+    groups = dict()
+    for jj in range(len(points)):
+        center = BT.find_containing_affinoid(points[jj])
+        groups.setdefault(tuple(center.list()),(center,[]))[1].append(jj)
+    values = Matrix(K,len(forms),len(points),0)
+    for center,idx in groups.itervalues():
+        E = BT.get_balls(center,level)
+        C = Matrix(K,len(forms),len(E)*depth,[[K(m) for e in E for m in moments(F,e)] for F in forms])
+        W = Matrix(K,len(E)*depth,len(idx),0)
+        for kk in range(len(E)):
+            a,b,c,d = E[kk].list()
+            num = K(E[kk].determinant()**(-ZZ(n/2)))*PS([d,c])**(n+1)
+            for col in range(len(idx)):
+                z = points[idx[col]]
+                g = (num*PS([b-z*d,a-z*c])**(-1)).padded_list(depth)
+                for ii in range(depth):
+                    W[kk*depth+ii,col] = g[ii]
+        V = C*W
+        for col in range(len(idx)):
+            for ii in range(len(forms)):
+                values[ii,idx[col]] = V[ii,col]
+    return values
+
+def _taylor_coefficients(f,E,n,depth):
+    r"""
+    Returns the matrix whose rows are the first ``depth`` Taylor
+    coefficients of `(cr+d)^n \det(e)^{-n/2} f((ar+b)/(cr+d))`, for
+    each of the matrices `e` in ``E``.
+
+    The rational function ``f`` is written in homogeneous form, so that
+    for each `e` only polynomials in `r` have to be built, followed by
+    a single division of power series.
+
+    INPUT:
+
+    - ``f`` - a rational function (or a polynomial) in one variable.
+    - ``E`` - a list of 2x2 matrices.
+    - ``n`` - integer. The weight.
+    - ``depth`` - integer. The number of coefficients to compute.
+    """
+    K = f.base_ring()
+    R2 = PolynomialRing(K,'r2')
+    R1 = LaurentSeriesRing(K,'r1')
+    R1.set_default_prec(depth)
+    P = f.numerator().list()
+    Q = f.denominator().list()
+    dp = len(P)-1
+    dq = len(Q)-1
+    G = []
+    for e in E:
+        a,b,c,d = e.list()
+        u = R2([b,a])
+        v = R2([d,c])
+        upows = [R2(1)]
+        for ii in range(max(dp,dq)):
+            upows.append(u*upows[ii])
+        vpows = [R2(1)]
+        for ii in range(n+dp+dq):
+            vpows.append(v*vpows[ii])
+        num = sum([K(P[ii])*upows[ii]*vpows[n+dq+dp-ii] for ii in range(dp+1)])
+        den = sum([K(Q[ii])*upows[ii]*vpows[dp+dq-ii] for ii in range(dq+1)])
+        g = K(e.determinant()**(-ZZ(n/2)))*R1(num)/R1(den)
+        G.append([g[ii] for ii in range(depth)])
+    return Matrix(K,len(E),depth,G)
+
 class HarmonicCocycleElement(HeckeModuleElement):
     r"""
     Objects of this type are Gamma-invariant harmonic cocycles on the 
@@ -336,9 +431,8 @@ class HarmonicCocycleElement(HeckeModuleElement):
 
         """
         R = self._R
-        A = self.parent().basis_matrix().transpose()
         B = Matrix(R,self._nE*(self.parent()._k-1),1,[self._F[e]._val[ii,0]  for e in range(self._nE) for ii in range(self.parent()._k-1) ])
-        res = (A.solve_right(B)).transpose()
+        res = self.parent()._solve_coordinates(B).transpose()
         return self.parent().free_module()(res.row(0))
 
     #In HarmonicCocycle
@@ -380,9 +474,9 @@ class HarmonicCocycleElement(HeckeModuleElement):
         R2 = PolynomialRing(f.base_ring(),'r2')
 
         if E is None:
-            E = self.parent()._X._BT.get_balls(center,level)
+            E = self.parent()._X._BT.get_balls_iter(center,level)
         else:
-            E = self.parent()._X._BT.subdivide(E,level)
+            E = self.parent()._X._BT.subdivide_iter(E,level)
         value = 0
         ii = 0
         for e in E:
@@ -399,6 +493,15 @@ class HarmonicCocycleElement(HeckeModuleElement):
         """
         return self.derivative(z,level,order = 0)
 
+    def modular_form_many(self,points,level = 0):
+        r"""
+        Returns the list of values of the modular form attached to
+        ``self`` at ``points``. See :meth:`HarmonicCocycles.modular_form_many`.
+
+        EXAMPLES::
+        """
+        return self.parent().modular_form_many([self],points,level).list()
+
     # In HarmonicCocycle
     def derivative(self,z = None,level = 0,order = 1):
         r"""
@@ -626,6 +729,40 @@ class HarmonicCocycles(AmbientHeckeModule):
         """
         return self._X.embed_quaternion(g,exact = self._R.is_exact(), prec = self._prec)
 
+    def modular_form_many(self,forms,points,level = 0):
+        r"""
+        Evaluates the modular forms attached to several harmonic
+        cocycles at several points at once, using Riemann sums.
+
+        INPUT:
+
+        - ``forms`` - a list of elements of ``self``.
+        - ``points`` - a list of points of the `p`-adic upper half
+          plane, all in the same field.
+        - ``level`` - integer (Default: 0). The level of the
+          covering used in the Riemann sums.
+
+        OUTPUT:
+
+        A matrix whose `(i,j)` entry is
+        ``forms[i].modular_form(points[j],level)``.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,19)
+            sage: C = HarmonicCocycles(X,4,prec = 20)
+            sage: B = C.basis()
+            sage: K.<a> = Qq(9,20)
+            sage: M = C.modular_form_many(B,[a,a+3])
+            sage: M[0,1] == B[0].modular_form(a+3)
+            True
+        """
+        X = self._X
+        d = self._k-1
+        def moments(F,e):
+            return F.evaluate(e).l_act_by(e.inverse())._val.list()
+        return _modular_form_values(X._BT,forms,points,level,self._k-2,d,moments)
+
     def basis_matrix(self):
         r"""
         Returns a basis of ``self`` in matrix form.
@@ -694,7 +831,10 @@ class HarmonicCocycles(AmbientHeckeModule):
             v = stab_conds[kk]
             self._M.set_block((nV+kk)*d,v[0]*d,v[1])
 
-        x1 = self._M.right_kernel().matrix()
+        if not self._R.is_exact() and self._R.absolute_degree() == 1:
+            x1 = self._padic_right_kernel(self._M)
+        else:
+            x1 = self._M.right_kernel().matrix()
 
         if x1.nrows() !=  self.rank():
             raise RuntimeError, 'The computed dimension does not agree with the expectation. Consider increasing precision!'
@@ -711,6 +851,179 @@ class HarmonicCocycles(AmbientHeckeModule):
         self.__matrix.set_immutable()
         return self.__matrix
 
+    def _padic_right_kernel(self,M):
+        r"""
+        Returns a matrix whose rows are a basis of the right kernel of
+        the `p`-adic matrix ``M``.
+
+        The computation is done with integers, by sparse Gaussian
+        elimination: each row is only reduced by the pivot rows
+        of the columns where it has nonzero entries, so that the
+        matrices coming from the quotient graph, which have a few
+        blocks in each row, stay sparse. The pivot of each row is an
+        entry of minimal valuation, and if a row meets a pivot of larger
+        valuation than its own entry the two rows are swapped.
+
+        Every entry is stored as a pair ``(a,n)``, meaning that it is
+        known modulo `p^n`, where `n` is at most the precision cap `N`
+        of the base ring. The initial `n` is the absolute precision of
+        the entry of ``M``, and it is updated at each elimination step.
+        Entries which are zero modulo their precision are never used as
+        pivots. The kernel is then found by back substitution over the
+        base ring, with each entry of the reduced matrix given the
+        precision to which it is known.
+
+        INPUT:
+
+        - ``M`` - a matrix over `\QQ_p`
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,19)
+            sage: C = HarmonicCocycles(X,4,prec = 20)
+            sage: M = Matrix(Qp(3,20),2,3,[1,2,3,3,6,9])
+            sage: K = C._padic_right_kernel(M)
+            sage: K.nrows()
+            2
+            sage: M*K.transpose() == 0
+            True
+
+        Here the second row is only known modulo `3^5`, so after the
+        elimination the entry `3^6` is zero to the known precision and
+        is not used as a pivot::
+
+            sage: R = Qp(3,20)
+            sage: M = Matrix(R,2,2,[1,1,R(1).add_bigoh(5),1+3^6])
+            sage: C._padic_right_kernel(M).nrows()
+            1
+        """
+        R = M.base_ring()
+        p = R.prime()
+        N = R.precision_cap()
+        entries = M.dict().items()
+        shift = min([x.valuation() for ij,x in entries if not x.is_zero()]+[0])
+        rows = dict()
+        for (ii,jj),x in entries:
+            n = min(N,x.precision_absolute()-shift)
+            a = 0 if x.is_zero() or n <= 0 else ZZ((p**(-shift)*x).lift())%(p**n)
+            rows.setdefault(ii,dict())[jj] = (a,n)
+
+        def val(a,n):
+            if a == 0:
+                return n
+            return a.valuation(p)
+
+        def eliminate(r,P,c):
+            ## Returns r minus the multiple of P which kills the entry at c
+            ac,nc = r[c]
+            bc,nb = P[c]
+            vr = val(ac,nc)
+            b = val(bc,nb)
+            vf = vr-b
+            nf = vf+min(nc-vr,nb-b)
+            pf = p**nf
+            factor = ((ac//p**b)*(bc//p**b).inverse_mod(pf))%pf
+            new = dict(r)
+            for jj,(a,n) in P.iteritems():
+                nt = min(nf+val(a,n),vf+n,N)
+                ar = 0
+                if jj in r:
+                    ar,nr = r[jj]
+                    nt = min(nt,nr)
+                new[jj] = ((ar-factor*a)%(p**nt) if nt > 0 else 0,nt)
+            return new
+
+        pivots = []
+        pivot_index = dict()
+        for ii in sorted(rows.keys()):
+            r = rows[ii]
+            while True:
+                nonzero = [jj for jj,(a,n) in r.iteritems() if a != 0]
+                if len(nonzero) == 0:
+                    break
+                present = [pivot_index[jj] for jj in nonzero if jj in pivot_index]
+                if len(present) == 0:
+                    c = min(nonzero,key = lambda jj:(val(*r[jj]),jj))
+                    pivot_index[c] = len(pivots)
+                    pivots.append((c,r))
+                    break
+                kk = min(present)
+                c,P = pivots[kk]
+                if val(*r[c]) < val(*P[c]):
+                    pivots[kk] = (c,r)
+                    r,P = P,r
+                r = eliminate(r,P,c)
+
+        ncols = M.ncols()
+        K = []
+        for f in range(ncols):
+            if f in pivot_index:
+                continue
+            x = {f:R(1)}
+            for c,P in reversed(pivots):
+                s = sum([R(a,absprec = n)*x[jj] for jj,(a,n) in P.iteritems() if jj != c and jj in x],R(0))
+                a,n = P[c]
+                x[c] = -s/R(a,absprec = n)
+            K.append([x.get(jj,R(0)) for jj in range(ncols)])
+        return Matrix(R,len(K),ncols,K)
+
+    def _coordinates_solver(self):
+        r"""
+        Returns a list ``rows`` of pivots of the transpose `A` of
+        :meth:`basis_matrix`, together with the inverse of the square
+        submatrix of `A` formed by these rows. Computed only once.
+
+        Any vector in the column space of `A` is then determined by its
+        entries in ``rows``, so that finding its coordinates amounts to
+        a product with the stored inverse. Over `p`-adic fields the
+        pivots are chosen with minimal valuation, to lose as little
+        precision as possible.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,19)
+            sage: C = HarmonicCocycles(X,4,prec = 20)
+            sage: rows,Ainv = C._coordinates_solver()
+            sage: len(rows) == C.dimension()
+            True
+        """
+        try: return self.__solver
+        except AttributeError: pass
+        M = self.basis_matrix()
+        n = M.nrows()
+        W = copy(M)
+        rows = []
+        for ii in range(n):
+            others = [jj for jj in range(M.ncols()) if jj not in rows]
+            if self._R.is_exact():
+                jj = filter(lambda jj:W[ii,jj] != 0,others)[0]
+            else:
+                jj = min(others,key = lambda jj:W[ii,jj].valuation())
+            rows.append(jj)
+            for rr in range(ii+1,n):
+                if W[rr,jj] != 0:
+                    W.add_multiple_of_row(rr,ii,-W[rr,jj]/W[ii,jj])
+        Ainv = M.matrix_from_columns(rows).transpose().inverse()
+        self.__solver = (rows,Ainv)
+        return self.__solver
+
+    def _solve_coordinates(self,B):
+        r"""
+        Returns the matrix `X` such that `AX = B`, where `A` is the
+        transpose of :meth:`basis_matrix` and the columns of ``B`` are
+        (the values of) harmonic cocycles.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,19)
+            sage: C = HarmonicCocycles(X,4,prec = 20)
+            sage: A = C.basis_matrix().transpose()
+            sage: C._solve_coordinates(A) == 1
+            True
+        """
+        rows,Ainv = self._coordinates_solver()
+        return Ainv*B.matrix_from_rows(rows)
+
     def __apply_atkin_lehner(self,q,f):
         r"""
         This function applies an Atkin-Lehner involution to a harmonic cocycle
@@ -744,25 +1057,26 @@ class HarmonicCocycles(AmbientHeckeModule):
 
         return HarmonicCocycleElement(self,tmp,from_values = True)
 
-    def __apply_hecke_operator(self,l,f):
+    def __hecke_operator_data(self,l):
         r"""
-        This function applies a Hecke operator to a harmonic cocycle.
-
-        INPUT:
-
-        - ``l`` - an integer
-
-        - ``f`` - a harmonic cocycle
+        Returns the data needed to apply the Hecke operator at ``l``,
+        computing it if necessary.
 
         OUTPUT:
 
-        - A harmonic cocycle which is the result of applying the lth Hecke operator
-          to f
+        A pair ``factor``, ``data``, where ``data[jj]`` is the list of
+        triples ``(label,sign,act)`` such that the value of `T_l(f)` at
+        the ``jj``-th edge is ``factor`` times the sum of
+        ``sign*f._F[label]._act_by_data(act)``. Here ``act`` is the
+        action data of a matrix ``mat``, as returned by
+        ``self._U._l_action_data(mat)``, so that the matrices are only
+        normalized once.
 
         EXAMPLES::
-
         """
-        R = self._R
+        try: return self.__hecke_data[l]
+        except AttributeError: self.__hecke_data = dict()
+        except KeyError: pass
         HeckeData,alpha = self._X._get_hecke_data(l)
         if(self.level()%l == 0):
             factor = QQ(l**(Integer((self._k-2)/2))/(l+1))
@@ -770,17 +1084,47 @@ class HarmonicCocycles(AmbientHeckeModule):
             factor = QQ(l**(Integer((self._k-2)/2)))
         p = self._X._p
         alphamat = self.embed_quaternion(alpha)
-        tmp = [self._U.element_class(self._U,zero_matrix(self._R,self._k-1,1),quick = True) for jj in range(len(self._E))]
+        nE = len(self._E)
+        data = [[] for jj in range(nE)]
         for ii in range(len(HeckeData)):
             d1 = HeckeData[ii][1]
             mga = self.embed_quaternion(HeckeData[ii][0])*alphamat
-            nE = len(self._E)
             for jj in range(nE):
                 t = d1[jj]
+                act = self._U._l_action_data(p**(-t.power)*mga*t.igamma(self.embed_quaternion))
                 if t.label < nE:
-                    tmp[jj] += f._F[t.label].l_act_by(p**(-t.power)*mga*t.igamma(self.embed_quaternion))
+                    data[jj].append((t.label,1,act))
+                else:
+                    data[jj].append((t.label-nE,-1,act))
+        self.__hecke_data[l] = (factor,data)
+        return factor,data
+
+    def __apply_hecke_operator(self,l,f):
+        r"""
+        This function applies a Hecke operator to a harmonic cocycle.
+
+        INPUT:
+
+        - ``l`` - an integer
+
+        - ``f`` - a harmonic cocycle
+
+        OUTPUT:
+
+        - A harmonic cocycle which is the result of applying the lth Hecke operator
+          to f
+
+        EXAMPLES::
+
+        """
+        factor,data = self.__hecke_operator_data(l)
+        tmp = [self._U.element_class(self._U,zero_matrix(self._R,self._k-1,1),quick = True) for jj in range(len(self._E))]
+        for jj in range(len(self._E)):
+            for label,sign,act in data[jj]:
+                if sign == 1:
+                    tmp[jj] += f._F[label]._act_by_data(act)
                 else:
-                    tmp[jj] += (-f._F[t.label-nE]).l_act_by(p**(-t.power)*mga*t.igamma(self.embed_quaternion))
+                    tmp[jj] += (-f._F[label])._act_by_data(act)
 
         return HarmonicCocycleElement(self,[factor*x for x in tmp],from_values = True)
 
@@ -825,6 +1169,60 @@ class HarmonicCocycles(AmbientHeckeModule):
         res = self.__compute_operator_matrix(lambda f:self.__apply_hecke_operator(l,f))
         return res
 
+    def hecke_matrices(self,bound):
+        r"""
+        Returns the matrices of the Hecke operators `T_l` for all
+        primes `l` up to ``bound``, in the basis given by
+        :meth:`basis_matrix`.
+
+        This is faster than calling :meth:`hecke_matrix` for each
+        prime, since the images of the basis under all the operators
+        are expressed in coordinates with a single linear solve. The
+        matrices are also stored, so that later calls to
+        :meth:`hecke_matrix` return them directly.
+
+        INPUT:
+
+        - ``bound`` - an integer
+
+        OUTPUT:
+
+        A dictionary mapping each prime `l \leq` ``bound`` to the
+        matrix of `T_l`.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,19)
+            sage: C = HarmonicCocycles(X,4,prec = 20)
+            sage: T = C.hecke_matrices(2)
+            sage: T.keys()
+            [2]
+            sage: T[2].nrows() == C.dimension()
+            True
+        """
+        R = self._R
+        basis = self.basis()
+        n = len(basis)
+        nrows = len(self._E) * (self._k-1)
+        primes = arith.prime_range(bound+1)
+        B = zero_matrix(R,nrows,n*len(primes))
+        for ii in range(len(primes)):
+            for rr in range(n):
+                g = self.__apply_hecke_operator(primes[ii],basis[rr])
+                B.set_block(0,ii*n+rr,Matrix(R,nrows,1,[g._F[e]._val[jj,0]  for e in range(len(self._E)) for jj in range(self._k-1) ]))
+
+        res = self._solve_coordinates(B)
+        try: cache = self._hecke_matrices
+        except AttributeError:
+            cache = self._hecke_matrices = dict()
+        ans = dict()
+        for ii in range(len(primes)):
+            M = res.matrix_from_columns(range(ii*n,(ii+1)*n)).transpose()
+            M.set_immutable()
+            cache[primes[ii]] = M
+            ans[primes[ii]] = M
+        return ans
+
     def __compute_operator_matrix(self,T):
         r"""
         Compute the matrix of the operator ``T``.
@@ -833,14 +1231,13 @@ class HarmonicCocycles(AmbientHeckeModule):
 
         """
         R = self._R
-        A = self.basis_matrix().transpose()
         basis = self.basis()
         B = zero_matrix(R,len(self._E) * (self._k-1),self.dimension())
         for rr in range(len(basis)):
             g = T(basis[rr])
             B.set_block(0,rr,Matrix(R,len(self._E) * (self._k-1),1,[g._F[e]._val[ii,0]  for e in range(len(self._E)) for ii in range(self._k-1) ]))
 
-        res = (A.solve_right(B)).transpose()
+        res = self._solve_coordinates(B).transpose()
         res.set_immutable()
         return res
 
@@ -922,6 +1319,7 @@ class pAutomorphicFormElement(ModuleElement):
         ModuleElement.__init__(self,parent)
         self._num_generators = len(parent._list)
         self._cached_values = dict()
+        self._cached_moments = dict()
         self._R = Qp(parent.prime(),prec = parent._prec)
         if quick:
             self._value = [ parent._U(v) for v in vec ]
@@ -1090,7 +1488,7 @@ class pAutomorphicFormElement(ModuleElement):
         """
         return(any([self._value[e].__nonzero__() for e in range(self._num_generators)]))
 
-    def improve(self, verbose = True):
+    def improve(self, verbose = True, accelerated = False, callback = None):
         r"""
         Repeatedly applies the `U_p` operator to a p-adic automorphic form. This
         is used to compute moments of a measure associated to a rigid modular form in the
@@ -1099,9 +1497,34 @@ class pAutomorphicFormElement(ModuleElement):
         The resulting form encodes the moments of the measure of the original rigid modular 
         form (assuming it is ordinary). 
 
+        INPUT:
+
+        - ``verbose`` - boolean (Default: True). If True and no
+          ``callback`` is given, prints a ``#`` after each step.
+
+        - ``accelerated`` - boolean (Default: False). Since the terms of
+          low degree are fixed, each step is an affine map `x \mapsto
+          Ax+b` on the remaining moments. If True, the map is composed
+          with itself at each step, so that the `j`-th step applies
+          `U_p` `2^j` times and the precision is reached in
+          logarithmically many steps, at the cost of multiplying
+          (sparse) matrices whose fill-in grows with each squaring.
+
+        - ``callback`` - a function (Default: None). If given, it is
+          called after each step with the number of the step and the
+          valuation of the difference between the last two
+          approximations.
 
         EXAMPLES::
 
+            sage: X = BTQuotient(3,11)
+            sage: M = HarmonicCocycles(X,4,30)
+            sage: A = pAutomorphicForms(X,4,10, overconvergent = True)
+            sage: F = A.lift(M.basis()[0], verbose = False)
+            sage: G = A(M.basis()[0])
+            sage: G.improve(verbose = False, accelerated = True)
+            sage: all([(a-b).is_zero() for jj in range(len(A._list)) for a,b in zip(F._value[jj]._val.list(),G._value[jj]._val.list())])
+            True
 
         REFERENCES:
 
@@ -1115,32 +1538,129 @@ class pAutomorphicFormElement(ModuleElement):
         - Marc Masdeu
 
         """
-        MMM = self.parent()
-        if verbose == True:
-            sys.stdout.flush()
-        h2 = MMM._apply_Up_operator(self,True)
+        if callback is None and verbose == True:
+            def callback(ii,val):
+                sys.stdout.write("#")
+                sys.stdout.flush()
+        if accelerated:
+            self._improve_accelerated(callback)
+        else:
+            MMM = self.parent()
+            h2 = MMM._apply_Up_operator(self,True)
+            ii = 0
+            current_val = 0
+            if callback is not None:
+                callback(ii,current_val)
+            old_val = -Infinity
+            init_val = self.valuation()
+            while(current_val>old_val):
+                old_val = current_val
+                ii += 1
+                self._value = [self.parent()._U(c) for c in h2._value]
+                h2 = MMM._apply_Up_operator(self,scale = True)
+                current_val = (h2-self).valuation()-init_val
+                if current_val is Infinity:
+                    break
+                if callback is not None:
+                    callback(ii,current_val)
+            self._value = [self.parent()._U(c) for c in h2._value]
+        self._cached_moments = dict()
         if verbose == True:
-            sys.stdout.write("#")
-            sys.stdout.flush()
+            print ''
+
+    def _improve_accelerated(self, callback = None):
+        r"""
+        Projects ``self`` to the ordinary part by repeated squaring of
+        the `U_p` operator. See :meth:`improve`.
+
+        The moments are scaled to integers and the affine map is
+        composed with itself as a sparse matrix modulo `p^N`, where `N`
+        is the precision of the parent, so that no precision is lost
+        or invented by the squarings. If the `U_p` operator is not
+        integral, this falls back to the iteration of :meth:`improve`.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,11)
+            sage: M = HarmonicCocycles(X,4,30)
+            sage: A = pAutomorphicForms(X,4,10, overconvergent = True)
+            sage: F = A(M.basis()[0])
+            sage: steps = []
+            sage: F._improve_accelerated(callback = lambda ii,v:steps.append(v))
+            sage: len(steps) > 0
+            True
+        """
+        MMM = self.parent()
+        R = MMM._R
+        p = MMM._p
+        n = MMM._n
+        depth = MMM._U.dimension()
+        nl = len(MMM._list)
+        shift,T = MMM._compile_Up_operator(scale = True)
+        if shift < 0:
+            return self.improve(verbose = False, callback = callback)
+        Rmod = MMM._U._Rmod
+        if shift > 0:
+            T = Rmod(p**shift)*T
+        low = [jj*depth+ii for jj in range(nl) for ii in range(n+1)]
+        high = [jj*depth+ii for jj in range(nl) for ii in range(n+1,depth)]
+        x = [self._value[jj]._val[ii,0] for jj in range(nl) for ii in range(depth)]
+        ## Work with the integers p^(-m)*x, known modulo p^prec
+        m = min([c.valuation() for c in x if not c.is_zero()]+[0])
+        prec = min([MMM._prec]+[c.precision_absolute()-m for c in x])
+        X = [Rmod(ZZ((p**(-m)*c).lift())) for c in x]
+        A = T.matrix_from_rows_and_columns(high,high)
+        b = T.matrix_from_rows_and_columns(high,low)*vector(Rmod,[X[ii] for ii in low])
+        H = vector(Rmod,[X[ii] for ii in high])
+        init_val = self.valuation()
         ii = 0
         current_val = 0
         old_val = -Infinity
-        init_val = self.valuation()
-        while(current_val>old_val):
+        while len(high) > 0:
+            ## Here A and b are such that x -> Ax + b is U_p applied 2^ii times
+            Hnew = A*H+b
+            diff = Hnew-H
+            H = Hnew
+            if diff.is_zero():
+                break
             old_val = current_val
-            ii += 1
-            self._value = [self.parent()._U(c) for c in h2._value]
-            h2 = MMM._apply_Up_operator(self,scale = True)
-            current_val = (h2-self).valuation()-init_val
-            # print 'val  = ',current_val
-            if current_val is Infinity:
+            current_val = m+min([ZZ(c).valuation(p) for c in diff if not c.is_zero()])-init_val
+            if callback is not None:
+                callback(ii,current_val)
+            if current_val <= old_val or current_val >= MMM._prec:
                 break
-            if verbose == True:
-                sys.stdout.write("#")
-                sys.stdout.flush()
-        if verbose == True:
-            print ''
-        self._value = [self.parent()._U(c) for c in h2._value]
+            b = A*b+b
+            A = A*A
+            ii += 1
+        for jj,kk in enumerate(high):
+            x[kk] = R(ZZ(H[jj])*p**m,absprec = m+prec)
+        self._value = [MMM._U(Matrix(R,depth,1,x[jj*depth:(jj+1)*depth])) for jj in range(nl)]
+        self._cached_moments = dict()
+
+    def _moments_on_covering(self,center = 1,level = 0):
+        r"""
+        Returns the covering of `\PP^1(\QQ_p)` by the balls of
+        ``get_balls(center,level)``, and the matrix whose rows are the
+        moments of ``self`` on each of them. Cached.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,11)
+            sage: M = HarmonicCocycles(X,4,30)
+            sage: A = pAutomorphicForms(X,4,10, overconvergent = True)
+            sage: F = A.lift(M.basis()[0], verbose = False)
+            sage: E,M = F._moments_on_covering()
+            sage: M.nrows() == len(E)
+            True
+        """
+        key = (tuple(center.list()) if hasattr(center,'list') else center,level)
+        try: return self._cached_moments[key]
+        except KeyError: pass
+        E = self.parent()._source._BT.get_balls(center,level)
+        U = self.parent()._U
+        M = Matrix(U._R,len(E),U.dimension(),[self.evaluate(e)._val.list() for e in E])
+        self._cached_moments[key] = (E,M)
+        return E,M
 
     def integrate(self,f,center = 1,level = 0,method = 'moments'):
         r"""
@@ -1167,12 +1687,11 @@ class pAutomorphicFormElement(ModuleElement):
         - Cameron Franc (2012-02-20)
 
         """
-        E = self.parent()._source._BT.get_balls(center,level)
-        R1 = LaurentSeriesRing(f.base_ring(),'r1')
-        R2 = PolynomialRing(f.base_ring(),'r2')
         value = 0
         ii = 0
         if(method == 'riemann_sum'):
+            E = self.parent()._source._BT.get_balls_iter(center,level)
+            R1 = LaurentSeriesRing(f.base_ring(),'r1')
             R1.set_default_prec(self.parent()._U.weight()+1)
             for e in E:
                 ii += 1
@@ -1182,19 +1701,23 @@ class pAutomorphicFormElement(ModuleElement):
                 new = self.evaluate(e).evaluate(exp.truncate(self.parent()._U.weight()+1))
                 value += new
         elif(method == 'moments'):
-            R1.set_default_prec(self.parent()._U.dimension())
-            for e in E:
-                ii += 1
-                #print ii,"/",len(E)
-                tmp = ((R2([e[1,1],e[1,0]]))**(self.parent()._U.weight())*e.determinant()**(-(self.parent()._U.weight())/2))*f(R2([e[0,1],e[0,0]])/R2([e[1,1],e[1,0]]))
-                exp = R1(tmp.numerator())/R1(tmp.denominator())
-                new = self.evaluate(e).evaluate(exp)
-                value += new
+            E,M = self._moments_on_covering(center,level)
+            G = _taylor_coefficients(f,E,self.parent()._U.weight(),self.parent()._U.dimension())
+            value = sum([x*y for x,y in zip(M.list(),G.list())])
         else:
             print 'The available methods are either "moments" or "riemann_sum". The latter is only provided for consistency check, and should never be used.'
             return False
         return value
 
+    def modular_form_many(self,points,level = 0):
+        r"""
+        Returns the list of values of the modular form attached to
+        ``self`` at ``points``. See :meth:`pAutomorphicForms.modular_form_many`.
+
+        EXAMPLES::
+        """
+        return self.parent().modular_form_many([self],points,level).list()
+
     def modular_form(self,z = None,level = 0,method = 'moments'):
         r"""
         Returns the modular form corresponding to ``self``.
@@ -1407,6 +1930,138 @@ class pAutomorphicFormElement(ModuleElement):
             return K.teichmuller(value_exp) * value.exp()
         return value
 
+    def coleman_many(self,pairs,method = 'moments',mult = False,delta = -1,level = 0):
+        r"""
+        Computes the Coleman integrals of ``self`` between each of the
+        pairs of points in ``pairs``. See :meth:`coleman`.
+
+        The coverings, the values of ``self`` on their edges and the
+        expansions of the logarithm on each edge are computed only once
+        and shared by all the pairs. Since
+
+        .. MATH::
+
+            \log\frac{x-t_1}{x-t_2} = \log(x-t_1) - \log(x-t_2),
+
+        the expansion for a pair is the difference of the expansions of
+        `\log((b-td)+(a-tc)r)` for each endpoint `t`, whose Taylor
+        coefficients are given in closed form.
+
+        INPUT:
+
+        - ``pairs`` - a list of pairs ``(t1,t2)`` of points of the `p`-adic
+          upper half plane, all in the same field.
+
+        - ``method``, ``mult``, ``delta``, ``level`` - as in :meth:`coleman`.
+
+        OUTPUT:
+
+        The list of the Coleman integrals between each pair of points.
+
+        EXAMPLES::
+
+            sage: p = 7
+            sage: X = BTQuotient(p,2, use_magma = True) # optional - magma
+            sage: M = HarmonicCocycles(X,2,20) # optional - magma
+            sage: MM = pAutomorphicForms(X,2,20,overconvergent = True) # optional - magma
+            sage: F = MM.lift(3*M.basis()[0], verbose = False) # long time optional - magma
+            sage: CM = X.get_CM_points(-11,prec = 20) # optional - magma
+            sage: P = CM[0]; Q = P.trace()-P # optional - magma
+            sage: F.coleman_many([(P,Q)],mult = True)[0] == F.coleman(P,Q,mult = True) # long time optional - magma
+            True
+        """
+        if(mult and delta >= 0):
+            raise NotImplementedError, "Need to figure out how to implement the multiplicative part."
+        BT = self.parent()._source._BT
+        # Points are identified by their index in this list
+        points = []
+        def index(t):
+            for ii in range(len(points)):
+                if points[ii] == t:
+                    return ii
+            points.append(t)
+            return len(points)-1
+        coverings = dict()
+        def covering(t1,t2):
+            i1,i2 = index(t1),index(t2)
+            try: return i1,i2,coverings[(i1,i2)]
+            except KeyError: pass
+            coverings[(i1,i2)] = BT.find_covering(t1,t2)
+            return i1,i2,coverings[(i1,i2)]
+
+        if method != 'moments':
+            return [self.coleman(t1,t2,covering(t1,t2)[2],method,mult,delta,level) for t1,t2 in pairs]
+
+        p = self.parent().prime()
+        K = pairs[0][0].parent()
+        depth = self.parent()._U.dimension()
+        R1 = LaurentSeriesRing(K,'r1')
+        R1.set_default_prec(depth)
+        r1 = R1.gen()
+
+        values = dict()
+        logs = dict()
+        teich = dict()
+        def edge_value(e,key):
+            try: return values[key]
+            except KeyError: pass
+            c_e = self.evaluate(e)
+            values[key] = (c_e._val.list(),Integer(c_e[0].rational_reconstruction()) if mult else None)
+            return values[key]
+        def log_expansion(e,key,it):
+            try: return logs[(key,it)]
+            except KeyError: pass
+            t = points[it]
+            a,b,c,d = e.list()
+            u0 = b-t*d
+            alpha = (a-t*c)/u0
+            u0 = p**(-u0.valuation())*u0
+            coeffs = [(u0/K.teichmuller(u0)).log()]
+            alphapow = K(1)
+            for jj in range(1,depth):
+                alphapow *= alpha
+                coeffs.append((-1)**(jj+1)*alphapow/jj)
+            logs[(key,it)] = coeffs
+            return coeffs
+        def teichmuller(e,key,it):
+            ## The valuation of b-dt and the Teichmuller lift of its unit part
+            try: return teich[(key,it)]
+            except KeyError: pass
+            a,b,c,d = e.list()
+            u = b-d*points[it]
+            v = u.valuation()
+            teich[(key,it)] = (v,K.teichmuller(p**(-v)*u))
+            return teich[(key,it)]
+
+        ans = []
+        for t1,t2 in pairs:
+            i1,i2,E = covering(t1,t2)
+            value = 0
+            value_exp = K(1)
+            for e in E:
+                key = tuple(e.list())
+                vals,c0 = edge_value(e,key)
+                l1 = log_expansion(e,key,i1)
+                l2 = log_expansion(e,key,i2)
+                poly = [l1[jj]-l2[jj] for jj in range(depth)]
+                if(delta >= 0):
+                    poly = R1(poly)*((r1-t1)**delta*(r1-t2)**(self.parent()._n-delta))
+                    poly = [poly[jj] for jj in range(depth)]
+                value += sum([vals[jj]*poly[jj] for jj in range(depth)])
+                if mult:
+                    v1,w1 = teichmuller(e,key,i1)
+                    v2,w2 = teichmuller(e,key,i2)
+                    if v1 == v2:
+                        value_exp  *=  (w1/w2)**c0
+                    else:
+                        a,b,c,d = e.list()
+                        value_exp  *=  K.teichmuller(((b-d*t1)/(b-d*t2)))**c0
+            if mult:
+                ans.append(K.teichmuller(value_exp) * value.exp())
+            else:
+                ans.append(value)
+        return ans
+
 
 class pAutomorphicForms(Module):
     Element = pAutomorphicFormElement
@@ -1502,6 +2157,40 @@ class pAutomorphicForms(Module):
         F.improve(verbose = verbose)
         return F
 
+    def modular_form_many(self,forms,points,level = 0):
+        r"""
+        Evaluates the modular forms attached to several `p`-adic
+        automorphic forms at several points at once, integrating
+        against their moments.
+
+        INPUT:
+
+        - ``forms`` - a list of elements of ``self``.
+        - ``points`` - a list of points of the `p`-adic upper half
+          plane, all in the same field.
+        - ``level`` - integer (Default: 0).
+
+        OUTPUT:
+
+        A matrix whose `(i,j)` entry is
+        ``forms[i].modular_form(points[j],level)``.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,11)
+            sage: M = HarmonicCocycles(X,4,30)
+            sage: A = pAutomorphicForms(X,4,10, overconvergent = True)
+            sage: F = A.lift(M.basis()[0], verbose = False)
+            sage: K.<a> = Qq(9,10)
+            sage: V = A.modular_form_many([F],[a,a+3])
+            sage: V[0,0] == F.modular_form(a)
+            True
+        """
+        depth = self._U.dimension()
+        def moments(F,e):
+            return F.evaluate(e)._val.list()
+        return _modular_form_values(self._source._BT,forms,points,level,self._n,depth,moments)
+
     def _make_invariant(self, F):
         r"""
         EXAMPLES::
@@ -1525,6 +2214,58 @@ class pAutomorphicForms(Module):
                 newF.append(x)
         return newF
 
+    def _compile_Up_operator(self,scale = False):
+        r"""
+        Returns the `U_p` operator as a sparse matrix acting on the
+        concatenated values of a form, computing it if necessary.
+
+        The matrix has one block of size the depth of the coefficient
+        module for each pair of edges related by the `U_p` data, and
+        its entries are integers modulo `p^N`, where `N` is the
+        precision of ``self``.
+
+        OUTPUT:
+
+        A pair ``shift``, ``T`` such that the matrix of `U_p` is
+        `p^{shift} T`.
+
+        EXAMPLES::
+
+            sage: X = BTQuotient(3,11)
+            sage: A = pAutomorphicForms(X,4,10, overconvergent = True)
+            sage: shift,T = A._compile_Up_operator()
+            sage: T.nrows() == len(X.get_list()) * A._U.dimension()
+            True
+        """
+        try: return self._Up_operators[scale]
+        except AttributeError: self._Up_operators = dict()
+        except KeyError: pass
+        HeckeData = self._source._get_Up_data()
+        if scale == False:
+            factor = (self._p)**(self._U.weight()/2)
+        else:
+            factor = 1
+        p = self._p
+        depth = self._U.dimension()
+        basis = self._U.basis()
+        blocks = []
+        for jj in range(len(self._list)):
+            for d in HeckeData:
+                gg = d[0] # acter
+                u = d[1][jj] # edge_list[jj]
+                act = self._U._r_action_data(self._p**(-(u.power)) * (u.t()*gg))
+                M = Matrix(self._R,depth,depth,[(factor*b._act_by_data(act))._val.list() for b in basis]).transpose()
+                blocks.append((jj,u.label,M.dict()))
+        shift = min([x.valuation() for jj,label,M in blocks for x in M.values() if not x.is_zero()]+[0])
+        Rmod = self._U._Rmod
+        T = Matrix(Rmod,len(self._list)*depth,len(self._list)*depth,sparse = True)
+        for jj,label,M in blocks:
+            for (ii,kk),x in M.iteritems():
+                T[jj*depth+ii,label*depth+kk] += Rmod(ZZ((p**(-shift)*x).lift()))
+        T.set_immutable()
+        self._Up_operators[scale] = (shift,T)
+        return shift,T
+
     def _apply_Up_operator(self,f,scale = False, fix_lowdeg_terms = True):
         r"""
         Apply the Up operator to ``f``.
@@ -1544,20 +2285,21 @@ class pAutomorphicForms(Module):
 
 
         """
-        HeckeData = self._source._get_Up_data()
-        if scale == False:
-            factor = (self._p)**(self._U.weight()/2)
-        else:
-            factor = 1
+        p = self._p
+        R = self._R
+        Rmod = self._U._Rmod
+        depth = self._U.dimension()
+        shift,T = self._compile_Up_operator(scale)
+        vals = [f._value[jj]._val[ii,0] for jj in range(len(self._list)) for ii in range(depth)]
+        m = min([x.valuation() for x in vals if not x.is_zero()]+[0])
+        w = T*vector(Rmod,[ZZ((p**(-m)*x).lift()) for x in vals])
+        ## The entries of w are only known modulo p^prec, where prec is
+        ## bounded by the modulus of Rmod and the precision of the input
+        prec = min([self._prec]+[x.precision_absolute()-m for x in vals])
+        val = m+shift
         Tf = []
         for jj in range(len(self._list)):
-            tmp = self._U(0)
-            for d in HeckeData:
-                gg = d[0] # acter
-                u = d[1][jj] # edge_list[jj]
-                r = self._p**(-(u.power)) * (u.t()*gg)
-                tmp += f._value[u.label].r_act_by(r)
-            tmp  *=  factor
+            tmp = self._U(Matrix(R,depth,1,[R(ZZ(w[jj*depth+ii])*p**val,absprec = val+prec) for ii in range(depth)]))
             for ii in range(self._n+1):
                 tmp[ii] = f._value[jj][ii]
             Tf.append(tmp)
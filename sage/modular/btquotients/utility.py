@@ -153,13 +153,9 @@ def find_relations(X,dmax,prec,generators,h=0):
     g=K.gen()
     max_num_monomials=binomial(genus+dmax-1,dmax)
 
-    sys.stdout.flush()
-    CEP=[]
-    for ii in range(max_num_monomials+h):
-        Pt=g+p*ii
-        sys.stdout.write("#")
-        sys.stdout.flush()
-        CEP.append([f.modular_form(Pt) for f in X])
+    Pts=[g+p*ii for ii in range(max_num_monomials+h)]
+    values=X[0].parent().modular_form_many(X,Pts)
+    CEP=[list(values.column(ii)) for ii in range(len(Pts))]
 
     V=[]
     for d in range(2,dmax+1):
@@ -10,10 +10,11 @@ from sage.rings.padics.pow_computer cimport PowComputer_long
 
 
 cdef class Dist(ModuleElement):
+    cdef bint _normalized
     cpdef normalize(self)
 
 cdef class Dist_vector(Dist):
-    cdef public moments
+    cdef readonly moments
     cdef Dist_vector _new_c(self)
 
 #cdef class Dist2(Dist): # only works on 64-bit....
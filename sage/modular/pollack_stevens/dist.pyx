@@ -27,7 +27,7 @@ from sage.rings.padics.padic_capped_absolute_element cimport pAdicCappedAbsolute
 from sage.rings.padics.padic_capped_relative_element cimport pAdicCappedRelativeElement
 from sage.rings.padics.padic_fixed_mod_element cimport pAdicFixedModElement
 from sage.rings.integer cimport Integer
-from sage.misc.misc import verbose, cputime
+from sage.misc.misc import verbose, cputime, get_verbose
 
 cdef extern from "zn_poly/zn_poly.h":
     pass
@@ -77,6 +77,12 @@ cdef class Dist(ModuleElement):
         The main p-adic distribution class, implemented as per the paper
         'Overconvergent Modular Symbols and p-adic L-functions' by Pollack
         & Stevens
+
+        Arithmetic operations do not normalize their result: each
+        distribution remembers whether it has been normalized since it
+        was created, so that normalizing is done once, when it is needed
+        (comparison, valuation, printing), and repeated calls to
+        :meth:`normalize` are free.
     """
     cpdef normalize(self):
         r"""
@@ -311,6 +317,7 @@ cdef class Dist(ModuleElement):
         """
         if p is None:
             p = self.parent()._p
+        self.normalize()
         n = self.precision_absolute()
         return min([n] + [a + self.moment(a).valuation(p) for a in range(n)])
 
@@ -348,6 +355,7 @@ cdef class Dist(ModuleElement):
         """
         if p is None:
             p = self.parent()._p
+        self.normalize()
         n = self.precision_absolute()
         return min([self.moment(a).valuation(p) for a in range(n)])
 
@@ -492,7 +500,15 @@ cdef class Dist_vector(Dist):
             sage: from sage.modular.pollack_stevens.distributions import Symk
             sage: Symk(4)(0)
             (0, 0, 0, 0, 0)
-            
+
+        The moments cannot be changed from Python, since the
+        distribution keeps track of whether they are normalized::
+
+            sage: x = Symk(4)(0)
+            sage: x.moments = 0
+            Traceback (most recent call last):
+            ...
+            AttributeError: attribute 'moments' of 'sage.modular.pollack_stevens.dist.Dist_vector' objects is not writable
         """
         Dist.__init__(self, parent)
         if check:
@@ -641,6 +657,90 @@ cdef class Dist_vector(Dist):
             ans.moments = self.moments[:len(right.moments)] - right.moments
         return ans
 
+    cpdef ModuleElement _iadd_(self, ModuleElement _right):
+        r"""
+        In-place sum of two distributions.
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 7, 5, base=QQ)
+            sage: v = D([1, 2, 3]); w = v
+            sage: v += D([1, 1, 1]); w
+            (2, 3, 4)
+        """
+        cdef Dist_vector right = _right
+        if len(self.moments) == len(right.moments):
+            self.moments = self.moments + right.moments
+        elif len(self.moments) < len(right.moments):
+            self.moments = self.moments + right.moments[:len(self.moments)]
+        else:
+            self.moments = self.moments[:len(right.moments)] + right.moments
+        self._normalized = False
+        return self
+
+    cpdef ModuleElement _isub_(self, ModuleElement _right):
+        r"""
+        In-place difference of two distributions.
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 7, 5, base=QQ)
+            sage: v = D([1, 2, 3]); v -= D([1, 1, 1]); v
+            (0, 1, 2)
+        """
+        cdef Dist_vector right = _right
+        if len(self.moments) == len(right.moments):
+            self.moments = self.moments - right.moments
+        elif len(self.moments) < len(right.moments):
+            self.moments = self.moments - right.moments[:len(self.moments)]
+        else:
+            self.moments = self.moments[:len(right.moments)] - right.moments
+        self._normalized = False
+        return self
+
+    def add_acted(self, _v, g, scalar=1):
+        r"""
+        Adds ``(v * g) * scalar`` to this distribution, in place.
+
+        INPUT:
+
+        - ``v`` -- a distribution with the same parent
+        - ``g`` -- a `2 \times 2` integer matrix
+        - ``scalar`` -- (default: 1) an element of the base ring
+
+        OUTPUT:
+
+        - this distribution
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 7, 5, base=QQ)
+            sage: v = D([1, 2, 3]); g = M2Z([1, 2, 0, 1])
+            sage: w = D([1, 1, 1]); w.add_acted(v, g, -1) == D([1, 1, 1]) - v * g
+            True
+        """
+        cdef Dist_vector v = _v
+        try:
+            g.set_immutable()
+        except AttributeError:
+            pass
+        w = v.moments * (<WeightKAction>self._parent._act).acting_matrix(g, len(v.moments))
+        if scalar == -1:
+            w = -w
+        elif scalar != 1:
+            w = w * scalar
+        if len(self.moments) == len(w):
+            self.moments = self.moments + w
+        elif len(self.moments) < len(w):
+            self.moments = self.moments + w[:len(self.moments)]
+        else:
+            self.moments = self.moments[:len(w)] + w
+        self._normalized = False
+        return self
+
     cpdef ModuleElement _lmul_(self, RingElement right):
         r"""
         Scalar product of a distribution with a ring element that coerces into the base ring.
@@ -681,9 +781,14 @@ cdef class Dist_vector(Dist):
 
         EXAMPLES::
 
-            sage: from sage.modular.pollack_stevens.distributions import Distributions, Symk
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 7, 3)
+            sage: D([1, 7, 7^2]) == D([1, 0, 0])
+            True
         """
-        return cmp(left.moments, right.moments)
+        left.normalize()
+        (<Dist_vector>right).normalize()
+        return cmp(left.moments, (<Dist_vector>right).moments)
 
     cpdef normalize(self):
         r"""
@@ -704,10 +809,15 @@ cdef class Dist_vector(Dist):
         EXAMPLES::
 
             sage: from sage.modular.pollack_stevens.distributions import Distributions, Symk
+            sage: D = Distributions(0, 7, 3, base=QQ)
+            sage: v = D([50, 50, 50]); v.normalize()
+            (50, 1, 1)
         """
+        if self._normalized:
+            return self
         p = self.parent()._p
         if not self.parent().is_symk(): # non-classical
-            if self.valuation() < 0:
+            if get_verbose() > 0 and min([a.valuation(p) for a in self.moments]) < 0:
                 verbose("Negative valuation!")
                 verbose("%s"%(self.moments))
             #assert self.valuation() >= 0, "moments not integral in normalization"
@@ -715,9 +825,10 @@ cdef class Dist_vector(Dist):
             R = V.base_ring()
             n = self.precision_absolute()
             if isinstance(R, pAdicGeneric):
-                self.moments = V([self.moment(i).add_bigoh(n-i) for i in range(n)])
+                self.moments = V([a.add_bigoh(n-i) for i, a in enumerate(self.moments)])
             else:
-                self.moments = V([self.moment(i)%(p**(n-i)) for i in range(n)])
+                self.moments = V([a % m for a, m in zip(self.moments, self.parent()._normalization_moduli(n))])
+        self._normalized = True
         return self
 
     def reduce_precision(self, M):
@@ -911,6 +1022,8 @@ cdef class Dist_long(Dist):
 
             sage: from sage.modular.pollack_stevens.distributions import Distributions, Symk
         """
+        if self._normalized:
+            return self
         cdef int i
         for i in range(self.prec):
             if self.moments[i] < 0:
@@ -918,6 +1031,7 @@ cdef class Dist_long(Dist):
                 self.moments[i] += self.prime_pow.small_powers[self.prec-i]
             elif self.moments[i] >= self.prime_pow.small_powers[self.prec-i]:
                 self.moments[i] = self.moments[i] % self.prime_pow.small_powers[self.prec-i]
+        self._normalized = True
         return self
 
     def moment(self, _n):
@@ -985,6 +1099,91 @@ cdef class Dist_long(Dist):
             ans.moments[i] = self.moments[i] - right.moments[i]
         return ans
 
+    cpdef ModuleElement _iadd_(self, ModuleElement _right):
+        r"""
+        In-place sum of two distributions.
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 5, 10)
+            sage: v = D([1, 2, 3]); w = v
+            sage: v += D([1, 1, 1]); w
+            (2, 3, 4)
+        """
+        cdef Dist_long right = _right
+        cdef int i
+        if right.prec < self.prec:
+            self.prec = right.prec
+        # Same overflow considerations as in _add_
+        for i in range(self.prec):
+            self.moments[i] += right.moments[i]
+        self._normalized = False
+        return self
+
+    cpdef ModuleElement _isub_(self, ModuleElement _right):
+        r"""
+        In-place difference of two distributions.
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 5, 10)
+            sage: v = D([1, 2, 3]); v -= D([1, 1, 1]); v
+            (0, 1, 2)
+        """
+        cdef Dist_long right = _right
+        cdef int i
+        if right.prec < self.prec:
+            self.prec = right.prec
+        for i in range(self.prec):
+            self.moments[i] -= right.moments[i]
+        self._normalized = False
+        return self
+
+    def add_acted(self, _v, g, scalar=1):
+        r"""
+        Adds ``(v * g) * scalar`` to this distribution, in place,
+        without creating the intermediate distributions.
+
+        INPUT:
+
+        - ``v`` -- a distribution with the same parent
+        - ``g`` -- a `2 \times 2` integer matrix
+        - ``scalar`` -- (default: 1) an integer
+
+        OUTPUT:
+
+        - this distribution
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 5, 10)
+            sage: v = D([1, 2, 3]); g = M2Z([1, 2, 0, 1])
+            sage: w = D([1, 1, 1]); w.add_acted(v, g, -1) == D([1, 1, 1]) - v * g
+            True
+        """
+        cdef Dist_long v = _v
+        cdef long M = v.prec
+        cdef long pM = self.prime_pow.small_powers[M]
+        cdef long s = mymod(scalar, pM)
+        cdef SimpleMat B = <SimpleMat>(<WeightKAction>self._parent._act).acting_matrix(g, M)
+        cdef long row, col, acc
+        if M < self.prec:
+            self.prec = M
+        self.quasi_normalize()
+        for col in range(self.prec):
+            acc = 0
+            for row in range(M):
+                acc += mymod(B._mat[M*col + row] * v.moments[row], pM)
+            acc = mymod(acc, pM)
+            if s != 1:
+                acc = mymod(acc * s, pM)
+            self.moments[col] += acc
+        self._normalized = False
+        return self
+
     cpdef ModuleElement _lmul_(self, RingElement _right):
         r"""
         
@@ -1055,6 +1254,8 @@ cdef class Dist_long(Dist):
         """
         cdef int i
         cdef Dist_long right = _right
+        left.normalize()
+        right.normalize()
         for i in range(left.prec):
             if left.moments[i] < right.moments[i]:
                 return -1
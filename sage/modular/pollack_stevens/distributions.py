@@ -324,6 +324,22 @@ class Distributions_abstract(Module):
             raise ValueError("Sym^k objects do not support approximation modules")
         return self.base_ring()**M
 
+    @cached_method
+    def _normalization_moduli(self, M):
+        """
+        Return the list `[p^M, p^{M-1}, \ldots, p]` of moduli used to
+        normalize a distribution with `M` moments.
+
+        EXAMPLES::
+
+            sage: from sage.modular.pollack_stevens.distributions import Distributions
+            sage: D = Distributions(0, 5, 10)
+            sage: D._normalization_moduli(3)
+            [125, 25, 5]
+        """
+        p = ZZ(self._p)
+        return [p**(M-i) for i in range(M)]
+
     def random_element(self, M=None):
         """
         Return a random element of the M-th approximation module.
@@ -364,6 +380,7 @@ class Distributions_abstract(Module):
             sage: D.clear_cache()
         """
         self.approx_module.clear_cache()
+        self._normalization_moduli.clear_cache()
         self._act.clear_cache()
 
     @cached_method
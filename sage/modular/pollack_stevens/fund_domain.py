@@ -28,7 +28,7 @@ from sage.rings.rational_field import QQ
 from sage.structure.sage_object import SageObject
 from sage.modules.free_module_element import zero_vector
 from copy import deepcopy
-from sage.misc.cachefunc import cached_method
+from sage.misc.cachefunc import cached_method, cached_function
 from sage.rings.arith import convergents,xgcd,gcd
 
 M2ZSpace = MatrixSpace_ZZ_2x2()
@@ -1479,6 +1479,30 @@ class ManinRelations(PSModularSymbolsDomain):
 
         return ans
 
+@cached_function
+def manin_relations(N):
+    r"""
+    Returns the Manin relations of level ``N``, shared by all the
+    spaces of modular symbols of that level.
+
+    Since the Manin relations do not depend on the coefficients, the
+    data cached on them by :meth:`ManinRelations.prep_hecke_on_gen` is
+    computed once per level instead of once per space.
+
+    INPUT:
+
+    - ``N`` -- a positive integer
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.fund_domain import manin_relations
+        sage: manin_relations(11) is manin_relations(11)
+        True
+        sage: manin_relations(11)
+        Manin Relations of level 11
+    """
+    return ManinRelations(Integer(N))
+
 def basic_hecke_matrix(a, ell):
     """
     Returns the matrix [1, a, 0, ell] (if a<ell) and [ell, 0, 0, 1] if a>=ell
@@ -222,19 +222,11 @@ class ManinMap(object):
         """
         L = self._manin.relations(B)
         # could raise KeyError if B is not a coset rep
-        if len(L) == 0:
-            t = self._codomain.zero_element()
-        else:
-            c, A, g = L[0]
+        t = self._codomain(0)
+        for c, A, g in L:
             A=M2Z(A)
             A.set_immutable()
-            g1 = (self._dict[g] * A)
-            t = g1 * c
-            for c, A, g in L[1:]:
-                A=M2Z(A)
-                A.set_immutable()
-                g1 = (self._dict[g] * A)
-                t += g1 * c
+            t.add_acted(self._dict[g], A, c)
         return t
 
     def __getitem__(self, B):
@@ -420,15 +412,15 @@ class ManinMap(object):
         # v2: a list of unimodular matrices whose divisors add up to {a/c} - {infty}
         v2 = unimod_matrices_to_infty(a,c)
         # ans: the value of self on A
-        ans = self._codomain.zero_element()
+        ans = self._codomain(0)
         # This loop computes self({b/d}-{infty}) by adding up the values of self on elements of v1
         for B in v1:
-            ans = ans + self._eval_sl2(B)
+            ans += self._eval_sl2(B)
 
         # This loops subtracts away the value self({a/c}-{infty}) from ans by subtracting away the values of self on elements of v2
         # and so in the end ans becomes self({b/d}-{a/c}) = self({A(0)} - {A(infty)}
         for B in v2:
-            ans = ans - self._eval_sl2(B)
+            ans -= self._eval_sl2(B)
         return ans
 
     def apply(self, f, codomain=None, to_moments=False):
@@ -560,10 +552,10 @@ class ManinMap(object):
                 ## the entries of v[h] (a list)
                 # verbose("prepping for T_%s: %s"%(ell, g), level = 2)
                 v = M.prep_hecke_on_gen(ell, g)
-                psi[g] = self._codomain.zero_element()
+                psi[g] = self._codomain(0)
                 for h in M:
                     for A in v[h]:
-                        psi[g] += self[h] * A
+                        psi[g].add_acted(self[h], A)
                 psi[g].normalize()
             return self.__class__(self._codomain, self._manin, psi, check=False)
         elif algorithm == 'naive':
@@ -881,7 +881,7 @@ class PSModularSymbolElement_symk(PSModularSymbolElement):
                 # no two or three torsion
                 D[g] = self._map[g].lift(p, M, new_base_ring)
 
-        t = self.parent().coefficient_module().lift(p, M, new_base_ring).zero_element()
+        t = self.parent().coefficient_module().lift(p, M, new_base_ring)(0)
         for h in manin[2:]:
             R = manin.relations(h)
             if len(R) == 1:
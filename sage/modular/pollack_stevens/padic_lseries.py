@@ -12,8 +12,9 @@ from sage.rings.all import ZZ, QQ
 from sage.rings.power_series_ring import PowerSeriesRing
 from sage.rings.big_oh import O
 from sage.rings.arith import binomial, gcd, kronecker
+from sage.misc.misc import walltime
 
-from fund_domain import M2Z
+from fund_domain import M2Z, manin_relations
 
 from sage.structure.sage_object import SageObject
 
@@ -352,7 +353,7 @@ class pAdicLseries(SageObject):
             if gcd(b, D) == 1:
                 M1 = M2Z([1, (b / abs(D)) % p**M, 0, 1])
                 new_dist = m_map(M1 * M2Z([a, 1, p, 0]))*(M1)
-                new_dist = new_dist.scale(kronecker(D, b)).normalize()
+                new_dist = new_dist.scale(kronecker(D, b))
                 twisted_dist = twisted_dist + new_dist
                 #ans = ans + self.eval(M1 * M2Z[a, 1, p, 0])._right_action(M1)._lmul_(kronecker(D, b)).normalize()
         return twisted_dist.normalize()
@@ -426,3 +427,79 @@ def log_gamma_binomial(p,gamma,z,n,M):
     L = sum([ZZ(-1)**j / j*z**j for j in range (1,M)]) #log_p(1+z)
     loggam = L / (L(gamma - 1))                  #log_{gamma}(1+z)= log_p(1+z)/log_p(gamma)
     return z.parent()(binomial(loggam,n)).truncate(M).list()
+
+def _padic_lseries_job(phi, p, M, n):
+    r"""
+    Lifts ``phi`` at `p` with `M` moments and returns the `n`-th
+    approximation to its `p`-adic `L`-series together with the wall
+    time spent. Used by :func:`padic_lseries_many`.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import ps_modsym_from_elliptic_curve
+        sage: from sage.modular.pollack_stevens.padic_lseries import _padic_lseries_job
+        sage: phi = ps_modsym_from_elliptic_curve(EllipticCurve('57a'))
+        sage: L, t = _padic_lseries_job(phi, 5, 4, 3); L
+        O(5^3) + (3*5 + 5^2 + O(5^3))*T + (5 + O(5^2))*T^2
+    """
+    t = walltime()
+    if phi.parent().level() % p == 0:
+        Phi = phi.lift(p, M, algorithm='stevens', eigensymbol=True)
+    else:
+        Phi = phi.p_stabilize_and_lift(p, M, algorithm='stevens', eigensymbol=True)
+    return pAdicLseries(Phi).series(n, M), walltime(t)
+
+def padic_lseries_many(phi, primes, M, n=3, ncpus=None):
+    r"""
+    Iterates over the `p`-adic `L`-series of the classical eigensymbol
+    ``phi`` at each prime in ``primes``.
+
+    The jobs for the different primes are independent. When ``ncpus``
+    is given they are distributed over that many forked processes; the
+    Manin relations of the level of ``phi`` and the data needed to
+    compute `U_p` on them, at level `N` if `p` divides the level `N`
+    of ``phi`` and at level `Np` otherwise, are computed beforehand.
+    They are shared by all the spaces of that level (see
+    :func:`~sage.modular.pollack_stevens.fund_domain.manin_relations`),
+    so that every process inherits them instead of recomputing them.
+
+    INPUT:
+
+    - ``phi`` -- a classical modular symbol which is an eigensymbol
+    - ``primes`` -- a list of primes at which ``phi`` is ordinary
+    - ``M`` -- the number of moments of the lifts
+    - ``n`` -- integer (default: 3); number of coefficients of each series
+    - ``ncpus`` -- integer or None (default: None); number of processes.
+      If None the primes are done one after another in this process.
+
+    OUTPUT:
+
+    - an iterator over triples ``(p, L, t)`` where ``L`` is the
+      approximation to the `p`-adic `L`-series and ``t`` the wall time
+      spent on it, in seconds. When running in parallel, the triples
+      come out in the order in which the jobs finish.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import ps_modsym_from_elliptic_curve
+        sage: from sage.modular.pollack_stevens.padic_lseries import padic_lseries_many
+        sage: phi = ps_modsym_from_elliptic_curve(EllipticCurve('57a'))
+        sage: [(p, L) for p, L, t in padic_lseries_many(phi, [5], 4)]
+        [(5, O(5^3) + (3*5 + 5^2 + O(5^3))*T + (5 + O(5^2))*T^2)]
+        sage: [(p, L) for p, L, t in padic_lseries_many(phi, [5], 4, ncpus=2)]
+        [(5, O(5^3) + (3*5 + 5^2 + O(5^3))*T + (5 + O(5^2))*T^2)]
+    """
+    if ncpus is None:
+        for p in primes:
+            L, t = _padic_lseries_job(phi, p, M, n)
+            yield p, L, t
+        return
+    from sage.parallel.decorate import parallel
+    N = phi.parent().level()
+    for p in primes:
+        manin = manin_relations(N if N % p == 0 else N * p)
+        for g in manin.gens():
+            manin.prep_hecke_on_gen(p, g)
+    job = parallel(ncpus=ncpus)(_padic_lseries_job)
+    for (args, kwds), (L, t) in job([(phi, p, M, n) for p in primes]):
+        yield args[1], L, t
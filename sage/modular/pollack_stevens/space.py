@@ -26,9 +26,19 @@ from sage.rings.integer import Integer
 from sage.rings.integer_ring import ZZ
 from sage.rings.rational_field import QQ
 from modsym import PSModularSymbolElement_symk, PSModularSymbolElement_dist, PSModSymAction
-from fund_domain import ManinRelations, M2ZSpace
+from fund_domain import manin_relations, M2ZSpace
 from sage.rings.padics.precision_error import PrecisionError
 from sage.rings.infinity import infinity as oo
+from sage.structure.sage_object import dumps, loads
+import struct, zlib, binascii, mmap
+
+# Layout of the header used by :meth:`PSModularSymbolSpace.save_symbol`:
+# magic, format version, flags, N, p, k, M, sign, number of generators,
+# bytes per moment and length of the pickled character.
+_SYMBOL_MAGIC = 'PSMS'
+_SYMBOL_VERSION = 1
+_SYMBOL_COMPRESSED = 1
+_symbol_header = struct.Struct('<4sBBqqqqbIII')
 
 class PSModularSymbols_factory(UniqueFactory):
     r"""
@@ -140,7 +150,7 @@ class PSModularSymbolSpace(Module):
             self.Element = PSModularSymbolElement_dist
         self._sign = sign
         # should distingish between Gamma0 and Gamma1...
-        self._source = ManinRelations(group.level())
+        self._source = manin_relations(group.level())
         # We have to include the first action so that scaling by Z doesn't try to pass through matrices
         actions = [PSModSymAction(ZZ, self), PSModSymAction(M2ZSpace, self)]
         self._populate_coercion_lists_(action_list=actions)
@@ -480,6 +490,136 @@ class PSModularSymbolSpace(Module):
         """
         return PSModularSymbols(self.group(), coefficients=self.coefficient_module().change_ring(new_base_ring), sign=self.sign())
 
+    def save_symbol(self, f, filename, compress=True):
+        r"""
+        Writes the overconvergent modular symbol ``f`` to ``filename``
+        in a compact binary format.
+
+        The file starts with a header recording `N`, `p`, `k`, `M`, the
+        sign and the character of self, followed by the moments of the
+        values of ``f`` on the generators of the Manin relations,
+        stored as a raw array of fixed width unsigned integers (each
+        moment is normalized, so it fits in `p^M`). This is much
+        smaller and faster than pickling the distributions one by one.
+
+        INPUT:
+
+        - ``f`` -- an element of self
+        - ``filename`` -- string
+        - ``compress`` -- boolean (default: True); whether to compress
+          the moment array with zlib. Uncompressed files can be read
+          back with ``use_mmap=True``.
+
+        EXAMPLES::
+
+            sage: D = Distributions(0, 5, 10);  M = PSModularSymbols(Gamma0(11), coefficients=D)
+            sage: f = M(1)
+            sage: fname = tmp_filename()
+            sage: M.save_symbol(f, fname)
+            sage: M.load_symbol(fname) == f
+            True
+            sage: M.save_symbol(f, fname, compress=False)
+            sage: M.load_symbol(fname, use_mmap=True) == f
+            True
+        """
+        if self.coefficient_module().is_symk():
+            raise TypeError("Coefficient module must be a space of distributions")
+        if f.parent() is not self:
+            f = self(f)
+        p = self.prime()
+        M = self.precision_cap()
+        width = (ZZ(p)**M).nbits() // 8 + 1
+        gens = self.source().gens()
+        precs = []
+        rows = []
+        zero = '\x00' * width
+        for g in gens:
+            val = f._map[g]
+            val.normalize()
+            n = val.precision_absolute()
+            precs.append(n)
+            rows.extend([binascii.unhexlify('%0*x'%(2*width, ZZ(val.moment(i)))) for i in range(n)])
+            rows.append(zero * (M - n))
+        body = struct.pack('<%sI'%len(precs), *precs) + ''.join(rows)
+        flags = 0
+        if compress:
+            body = zlib.compress(body)
+            flags |= _SYMBOL_COMPRESSED
+        character = dumps(self.coefficient_module()._character)
+        header = _symbol_header.pack(_SYMBOL_MAGIC, _SYMBOL_VERSION, flags, self.level(), p,
+                                     self.weight(), M, self.sign(), len(gens), width, len(character))
+        fobj = open(filename, 'wb')
+        try:
+            fobj.write(header)
+            fobj.write(character)
+            fobj.write(body)
+        finally:
+            fobj.close()
+
+    def load_symbol(self, filename, use_mmap=False):
+        r"""
+        Reads back an overconvergent modular symbol written by
+        :meth:`save_symbol`.
+
+        INPUT:
+
+        - ``filename`` -- string
+        - ``use_mmap`` -- boolean (default: False); if True and the
+          file is not compressed, the moment array is read through a
+          memory map instead of being loaded in memory at once.
+
+        OUTPUT:
+
+        - an element of self
+
+        EXAMPLES::
+
+            sage: D = Distributions(2, 7, 8);  M = PSModularSymbols(Gamma0(7), coefficients=D)
+            sage: f = M.an_element()
+            sage: fname = tmp_filename()
+            sage: M.save_symbol(f, fname)
+            sage: g = M.load_symbol(fname); g == f
+            True
+            sage: D = Distributions(2, 7, 6);  M6 = PSModularSymbols(Gamma0(7), coefficients=D)
+            sage: M6.load_symbol(fname)
+            Traceback (most recent call last):
+            ...
+            ValueError: file does not contain a symbol in this space
+        """
+        fobj = open(filename, 'rb')
+        raw = None
+        try:
+            if use_mmap:
+                raw = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+                data = raw
+            else:
+                data = fobj.read()
+            magic, version, flags, N, p, k, M, sign, ngens, width, clen = _symbol_header.unpack_from(data, 0)
+            if magic != _SYMBOL_MAGIC or version != _SYMBOL_VERSION:
+                raise ValueError("not a modular symbol file")
+            offset = _symbol_header.size
+            character = loads(data[offset:offset + clen])
+            offset += clen
+            if (N, p, k, M, sign) != (self.level(), self.prime(), self.weight(), self.precision_cap(), self.sign()) \
+                    or character != self.coefficient_module()._character or ngens != self.ngens():
+                raise ValueError("file does not contain a symbol in this space")
+            if flags & _SYMBOL_COMPRESSED:
+                data = zlib.decompress(buffer(data, offset))
+                offset = 0
+            # The moments are read in place, without copying the array
+            precs = struct.unpack_from('<%sI'%ngens, data, offset)
+            offset += 4 * ngens
+            D = self.coefficient_module()
+            val = {}
+            for g, n in zip(self.source().gens(), precs):
+                val[g] = D([ZZ(binascii.hexlify(buffer(data, offset + i*width, width)), 16) for i in range(n)])
+                offset += width * M
+        finally:
+            if raw is not None:
+                raw.close()
+            fobj.close()
+        return self(val)
+
     def _an_element_(self):
         r"""
         Returns a "typical" element of self; in this case the constant map sending every element
@@ -580,18 +720,152 @@ def ps_modsym_from_elliptic_curve(E):
     """
     if not (E.base_ring() is QQ):
         raise ValueError("The elliptic curve must be defined over the rationals.")
-    N = E.conductor()
-    V = PSModularSymbols(Gamma0(N), 2)
+    V = PSModularSymbols(Gamma0(E.conductor()), 2)
+    return _ps_modsym_from_elliptic_curve(E, V, _gens_and_cusps(V))
+
+def _gens_and_cusps(V):
+    r"""
+    Returns the generators of the Manin relations of ``V`` together
+    with the pair of cusps attached to each of them.
+
+    This only depends on the level, so it is shared by all the curves
+    of a given conductor.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import _gens_and_cusps
+        sage: V = PSModularSymbols(Gamma0(11), 2)
+        sage: [c for g, c in _gens_and_cusps(V)]
+        [(+Infinity, 0), (0, -1/3), (-1/3, -1/2)]
+    """
+    return [(g, cusps_from_mat(g)) for g in V.source().gens()]
+
+def _ps_modsym_from_elliptic_curve(E, V, gens_and_cusps):
+    r"""
+    Returns the PS modular symbol of ``E`` in the space ``V``, using
+    the precomputed output ``gens_and_cusps`` of :func:`_gens_and_cusps`.
+
+    Consecutive generators share cusps, so the modular symbols of ``E``
+    are only evaluated once at each cusp.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import _gens_and_cusps, _ps_modsym_from_elliptic_curve
+        sage: V = PSModularSymbols(Gamma0(11), 2)
+        sage: _ps_modsym_from_elliptic_curve(EllipticCurve('11a'), V, _gens_and_cusps(V)).values()
+        [-1/5, 3/2, -1/2]
+    """
     D = V.coefficient_module()
-    manin = V.source()
     plus_sym = E.modular_symbol(sign = 1)
     minus_sym = E.modular_symbol(sign = -1)
+    symb = {}
+    def value(c):
+        try:
+            return symb[c]
+        except KeyError:
+            symb[c] = plus_sym(c) + minus_sym(c)
+            return symb[c]
     val = {}
-    for g in manin.gens():
-        ac, bd = cusps_from_mat(g)
-        val[g] = D([plus_sym(ac) + minus_sym(ac) - plus_sym(bd) - minus_sym(bd)])
+    for g, (ac, bd) in gens_and_cusps:
+        val[g] = D([value(ac) - value(bd)])
     return V(val)
 
+def _lift_ps_modsym(phi, p, M):
+    r"""
+    Lifts the weight 2 symbol ``phi`` to an overconvergent symbol at
+    `p` with `M` moments, `p`-stabilizing first when `p` does not
+    divide the level. Since ``phi`` comes from an elliptic curve, it is
+    lifted as an eigensymbol. Used by
+    :func:`ps_modsym_from_elliptic_curves`.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import ps_modsym_from_elliptic_curve, _lift_ps_modsym
+        sage: phi = ps_modsym_from_elliptic_curve(EllipticCurve('11a'))
+        sage: _lift_ps_modsym(phi, 11, 5).precision_absolute()
+        5
+    """
+    if phi.parent().level() % p == 0:
+        return phi.lift(p, M, eigensymbol=True)
+    return phi.p_stabilize_and_lift(p, M, eigensymbol=True)
+
+def _lift_ps_modsym_indexed(i, phi, p, M):
+    r"""
+    Same as :func:`_lift_ps_modsym`. The index ``i`` is not used, but
+    it is part of the arguments returned by a parallel call, so that
+    each lift can be matched with its curve.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import ps_modsym_from_elliptic_curve, _lift_ps_modsym_indexed
+        sage: phi = ps_modsym_from_elliptic_curve(EllipticCurve('11a'))
+        sage: _lift_ps_modsym_indexed(0, phi, 11, 5).precision_absolute()
+        5
+    """
+    return _lift_ps_modsym(phi, p, M)
+
+def ps_modsym_from_elliptic_curves(curves, p=None, M=None, ncpus=None):
+    r"""
+    Iterates over the PS modular symbols associated to a collection of
+    elliptic curves defined over the rationals.
+
+    Consecutive curves with the same conductor share the space of
+    modular symbols, its Manin relations and the cusps attached to the
+    generators, so the input should be sorted by conductor (as in
+    Cremona's tables) to get the most out of this function.
+
+    INPUT:
+
+    - ``curves`` -- an iterable of elliptic curves over `\QQ`
+    - ``p`` -- prime or None (default: None); if given, every symbol is
+      lifted to an overconvergent symbol at `p`
+    - ``M`` -- integer or None (default: None); the number of moments
+      of the lifts
+    - ``ncpus`` -- integer or None (default: None); if given, the lifts
+      of the curves of each conductor are computed in parallel by that
+      many processes
+
+    OUTPUT:
+
+    - an iterator over pairs ``(E, phi)``. When lifting in parallel the
+      pairs of a given conductor come out in the order in which the
+      lifts finish.
+
+    EXAMPLES::
+
+        sage: from sage.modular.pollack_stevens.space import ps_modsym_from_elliptic_curve, ps_modsym_from_elliptic_curves
+        sage: curves = [EllipticCurve(lab) for lab in ['11a1', '11a2', '14a1']]
+        sage: S = list(ps_modsym_from_elliptic_curves(curves))
+        sage: [E.cremona_label() for E, phi in S]
+        ['11a1', '11a2', '14a1']
+        sage: all([phi == ps_modsym_from_elliptic_curve(E) for E, phi in S])
+        True
+        sage: [phi.precision_absolute() for E, phi in ps_modsym_from_elliptic_curves(curves[:2], p=3, M=5)]
+        [5, 5]
+        sage: sorted([(E.cremona_label(), phi.precision_absolute()) for E, phi in ps_modsym_from_elliptic_curves(curves, p=3, M=5, ncpus=2)])
+        [('11a1', 5), ('11a2', 5), ('14a1', 5)]
+    """
+    from itertools import groupby
+    for N, group in groupby(curves, lambda E: E.conductor()):
+        V = PSModularSymbols(Gamma0(N), 2)
+        gens_and_cusps = _gens_and_cusps(V)
+        pairs = []
+        for E in group:
+            if not (E.base_ring() is QQ):
+                raise ValueError("The elliptic curve must be defined over the rationals.")
+            phi = _ps_modsym_from_elliptic_curve(E, V, gens_and_cusps)
+            if p is None:
+                yield E, phi
+            elif ncpus is None:
+                yield E, _lift_ps_modsym(phi, p, M)
+            else:
+                pairs.append((E, phi))
+        if pairs:
+            from sage.parallel.decorate import parallel
+            lift = parallel(ncpus=ncpus)(_lift_ps_modsym_indexed)
+            for (args, kwds), Phi in lift([(i, phi, p, M) for i, (E, phi) in enumerate(pairs)]):
+                yield pairs[args[0]][0], Phi
+
 def ps_modsym_from_simple_modsym_space(A):
     """
     Returns some choice -- only well defined up a nonzero scalar (!)